@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# Benchmarks the bot's hot paths against a local mock Connect API and fake pod services.
+# Run from the project root: python3 -m benchmarks --users 10,100,1000
+import argparse
+import asyncio
+import math
+import time
+from types import SimpleNamespace
+
+from src.activities_entitlement import EntitlementsMainMenuFormReplyActivity, EntitlementsSearchFormReplyActivity
+from src.activities_permissions import PermissionsMainMenuFormReplyActivity, PermissionsSearchFormReplyActivity, PermissionsBulkApplyFormReplyActivity
+from src.chunked_messages import ChunkedMessageSender
+from src.client.connect_client import AsyncConnectApiClient
+from src.entitlement_index import EntitlementIndex
+from src.metrics import MetricsRegistry
+from src.page_prefetcher import EntitlementPagePrefetcher
+from src.permission_service import PermissionService
+from src.templates import TemplateRegistry
+from src.user_cache import UserProfileCache
+from src.user_resolver import UserResolver
+
+from .fakes import FakeMessageService, FakeUserService, form_context, make_users
+from .mock_connect import MockConnectServer
+
+NETWORK = 'WHATSAPP'
+
+
+class BotStack():
+    # The same wiring as __main__.run, pointed at the mock server and fake services
+
+    def __init__(self, server, users, templates, args):
+        self.config = SimpleNamespace(ssl=None, context={NETWORK: {
+            'apiURL': server.url,
+            'publicKeyId': 'benchmark',
+            'maxConcurrency': args.concurrency,
+            'rateLimit': {'rate': args.rate, 'burst': args.rate},
+            'retry': {'baseDelay': 0.05}
+        }})
+        self.metrics = MetricsRegistry()
+        self.connect_client = AsyncConnectApiClient(self.config, self.metrics)
+        # No private key is needed, the mock server accepts any token
+        self.connect_client.token_manager.tokens[NETWORK] = ('benchmark-token', time.time() + 3600)
+        self.users = FakeUserService(users, args.pod_latency)
+        self.messages = FakeMessageService(args.send_latency)
+        self.templates = templates
+        self.user_resolver = UserResolver(self.users, UserProfileCache())
+        self.permission_service = PermissionService(self.connect_client, self.config)
+        self.entitlement_index = EntitlementIndex(self.connect_client, self.config)
+        self.page_prefetcher = EntitlementPagePrefetcher(self.connect_client, self.user_resolver)
+        self.chunked_sender = ChunkedMessageSender(self.messages)
+
+    def pod_calls(self):
+        return sum(self.users.calls.values()) + sum(self.messages.calls.values())
+
+    async def close(self):
+        for task, _ in self.page_prefetcher.pages.values():
+            task.cancel()
+        await asyncio.gather(*[task for task, _ in self.page_prefetcher.pages.values()], return_exceptions=True)
+        await self.connect_client.close()
+
+
+def entitlements_view(stack, users):
+    activity = EntitlementsMainMenuFormReplyActivity(stack.messages, stack.templates, stack.user_resolver,
+                                                     stack.connect_client, stack.page_prefetcher)
+    return activity, form_context('main-menu-form', action='view_delete_entitlements', externalNetwork=NETWORK)
+
+
+def entitlements_search(stack, users):
+    activity = EntitlementsSearchFormReplyActivity(stack.messages, stack.templates, stack.user_resolver,
+                                                   stack.connect_client, stack.entitlement_index)
+    return activity, form_context('entitlements-search-form', action='search', externalNetwork=NETWORK,
+                                  userlist=[symphonyId for symphonyId, _ in users])
+
+
+def permissions_view(stack, users):
+    activity = PermissionsMainMenuFormReplyActivity(stack.messages, stack.templates, stack.user_resolver,
+                                                    stack.connect_client, stack.permission_service, stack.page_prefetcher, stack.chunked_sender)
+    return activity, form_context('main-menu-form', action='view_edit_permissions', externalNetwork=NETWORK)
+
+
+def permissions_search(stack, users):
+    activity = PermissionsSearchFormReplyActivity(stack.messages, stack.templates, stack.user_resolver, stack.connect_client,
+                                                  stack.permission_service, stack.entitlement_index, stack.chunked_sender)
+    return activity, form_context('permissions-search-form', action='search', externalNetwork=NETWORK,
+                                  userlist=[symphonyId for symphonyId, _ in users])
+
+
+def permissions_bulk_apply(stack, users):
+    activity = PermissionsBulkApplyFormReplyActivity(stack.messages, stack.templates, stack.permission_service)
+    return activity, form_context('permissions-bulk-edit-form', action='apply', externalNetwork=NETWORK,
+                                  advisorEmails='\n'.join(email for _, email in users),
+                                  new_permissions=['CAN_CALL'], del_permissions=['CAN_BROADCAST'])
+
+
+SCENARIOS = {
+    'entitlements_view': entitlements_view,
+    'entitlements_search': entitlements_search,
+    'permissions_view': permissions_view,
+    'permissions_search': permissions_search,
+    'permissions_bulk_apply': permissions_bulk_apply
+}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))]
+
+
+async def run_scenario(name, server, users, templates, args):
+    stack = None
+    latencies = []
+    connect_calls = []
+    pod_calls = []
+    message_sizes = []
+
+    try:
+        for iteration in range(args.warmup + args.iterations):
+            # Cold caches on every run unless --warm, which measures the steady state
+            if stack is None or not args.warm:
+                if stack is not None:
+                    await stack.close()
+                stack = BotStack(server, users, templates, args)
+
+            activity, context = SCENARIOS[name](stack, users)
+            connect_before = server.total_calls()
+            pod_before = stack.pod_calls()
+            sent_before = len(stack.messages.sizes)
+
+            start = time.perf_counter()
+            await activity.on_activity(context)
+            elapsed = time.perf_counter() - start
+
+            if iteration >= args.warmup:
+                latencies.append(elapsed)
+                connect_calls.append(server.total_calls() - connect_before)
+                pod_calls.append(stack.pod_calls() - pod_before)
+                message_sizes.append(sum(stack.messages.sizes[sent_before:]))
+    finally:
+        if stack is not None:
+            await stack.close()
+
+    return {
+        'scenario': name,
+        'users': len(users),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'connect_calls': sum(connect_calls) / len(connect_calls),
+        'pod_calls': sum(pod_calls) / len(pod_calls),
+        'message_kb': sum(message_sizes) / len(message_sizes) / 1024
+    }
+
+
+async def run_index_build(server, users, templates, args):
+    latencies = []
+    connect_calls = []
+    for _ in range(args.iterations):
+        stack = BotStack(server, users, templates, args)
+        try:
+            connect_before = server.total_calls()
+            start = time.perf_counter()
+            await stack.entitlement_index.build(NETWORK)
+            latencies.append(time.perf_counter() - start)
+            connect_calls.append(server.total_calls() - connect_before)
+        finally:
+            await stack.close()
+
+    return {
+        'scenario': 'entitlement_index_build',
+        'users': len(users),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'connect_calls': sum(connect_calls) / len(connect_calls),
+        'pod_calls': 0,
+        'message_kb': 0
+    }
+
+
+def print_results(results):
+    header = f'{"scenario":<26}{"users":>7}{"p50 ms":>10}{"p99 ms":>10}{"connect/run":>13}{"pod/run":>10}{"msg KB":>9}'
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f'{r["scenario"]:<26}{r["users"]:>7}{r["p50_ms"]:>10.1f}{r["p99_ms"]:>10.1f}'
+              f'{r["connect_calls"]:>13.1f}{r["pod_calls"]:>10.1f}{r["message_kb"]:>9.1f}')
+
+
+async def run(args):
+    templates = TemplateRegistry()
+    templates.preload()
+    scenarios = args.scenario or list(SCENARIOS.keys()) + ['entitlement_index_build']
+    results = []
+
+    for count in args.users:
+        users = make_users(count)
+        for name in scenarios:
+            # Fresh server per scenario so writes from one do not leak into the next
+            server = MockConnectServer(NETWORK, users, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.page_size)
+            await server.start()
+            try:
+                if name == 'entitlement_index_build':
+                    results.append(await run_index_build(server, users, templates, args))
+                else:
+                    results.append(await run_scenario(name, server, users, templates, args))
+            finally:
+                await server.stop()
+
+    print_results(results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark bot activities against a local mock Connect API')
+    parser.add_argument('--users', type=lambda v: [int(n) for n in v.split(',')], default=[10, 100, 1000],
+                        help='comma separated entitled user counts (default: 10,100,1000)')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS.keys()) + ['entitlement_index_build'],
+                        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--warm', action='store_true', help='keep caches between iterations')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock Connect latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='standard deviation of the Connect latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of Connect calls failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of Connect calls rejected with 429')
+    parser.add_argument('--page-size', type=int, default=MockConnectServer.DEFAULT_PAGE_SIZE)
+    parser.add_argument('--pod-latency', type=float, default=0.03, help='fake UserService latency in seconds')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='fake MessageService latency in seconds')
+    parser.add_argument('--concurrency', type=int, default=AsyncConnectApiClient.DEFAULT_MAX_CONCURRENCY)
+    # High by default so the client and activities are measured rather than the rate limiter
+    parser.add_argument('--rate', type=float, default=1000, help='Connect requests per second allowed by the client')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,58 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+
+def make_users(count, first_id=349026222340000):
+    # (symphonyId, email) pairs for a population of advisors
+    return [(first_id + i, f'advisor{i}@example.com') for i in range(count)]
+
+
+class FakeUserService():
+    # Stand-in for the BDK UserService calls made by UserResolver
+
+    def __init__(self, users, latency=0.03):
+        self.latency = latency
+        self.calls = Counter()
+        self.profiles = {symphonyId: {'id': symphonyId, 'display_name': f'Advisor {i}', 'email_address': email}
+                         for i, (symphonyId, email) in enumerate(users)}
+        self.by_email = {p['email_address'].lower(): p for p in self.profiles.values()}
+
+    async def list_users_by_ids(self, user_ids, **kwargs):
+        self.calls['list_users_by_ids'] += 1
+        await asyncio.sleep(self.latency)
+        return {'users': [self.profiles[int(i)] for i in user_ids if int(i) in self.profiles]}
+
+    async def list_users_by_emails(self, emails, **kwargs):
+        self.calls['list_users_by_emails'] += 1
+        await asyncio.sleep(self.latency)
+        return {'users': [self.by_email[e.lower()] for e in emails if e.lower() in self.by_email]}
+
+
+class FakeMessageService():
+    # Stand-in for the BDK MessageService, records the size of every message sent
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = Counter()
+        self.sizes = []
+        self.next_id = 0
+
+    async def send_message(self, stream_id, message, *args, **kwargs):
+        return await self.post('send_message', message)
+
+    async def update_message(self, stream_id, message_id, message, *args, **kwargs):
+        return await self.post('update_message', message)
+
+    async def post(self, name, message):
+        self.calls[name] += 1
+        self.sizes.append(len(message))
+        await asyncio.sleep(self.latency)
+        self.next_id += 1
+        return SimpleNamespace(message_id=f'message-{self.next_id}')
+
+
+def form_context(form_id, **form_values):
+    # Minimal FormReplyContext carrying what the activities read
+    return SimpleNamespace(form_id=form_id, form_values=form_values,
+                           source_event=SimpleNamespace(stream=SimpleNamespace(stream_id='benchmark-stream')))
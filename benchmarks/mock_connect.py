@@ -0,0 +1,125 @@
+import asyncio
+import random
+from collections import Counter
+
+from aiohttp import web
+
+
+class MockConnectServer():
+    # Local stand-in for the Connect endpoints used by AsyncConnectApiClient, with injectable
+    # latency, 5xx errors and 429 throttling. Entitlements are paged with an opaque ?cursor= suffix.
+
+    DEFAULT_PAGE_SIZE = 100
+    PERMISSIONS = ['CAN_CHAT', 'CAN_SEND_FILES', 'CAN_SEND_VOICE', 'CAN_CALL', 'CAN_CREATE_ROOM', 'CAN_BROADCAST']
+
+    def __init__(self, externalNetwork, users, latency=0.02, jitter=0.01, error_rate=0.0, throttle_rate=0.0,
+                 page_size=DEFAULT_PAGE_SIZE, host='127.0.0.1', port=0):
+        self.externalNetwork = externalNetwork
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self.runner = None
+        # users is a list of (symphonyId, email) of entitled advisors
+        self.entitlements = {str(symphonyId): {'symphonyId': str(symphonyId), 'externalNetwork': externalNetwork}
+                             for symphonyId, _ in users}
+        self.advisor_permissions = {email.lower(): self.PERMISSIONS[:i % len(self.PERMISSIONS) + 1]
+                                    for i, (_, email) in enumerate(users)}
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        app = web.Application(middlewares=[self.inject_faults])
+        advisor_path = '/api/v1/customer/advisors/advisorEmailAddress/{advisorEmail}/externalNetwork/{externalNetwork}/permissions'
+        app.router.add_get('/api/v1/customer/permissions', self.list_permission)
+        app.router.add_get(advisor_path, self.get_advisor_permission)
+        app.router.add_post(advisor_path, self.add_permission)
+        app.router.add_delete(advisor_path + '/{permissionName}', self.delete_permission)
+        app.router.add_get('/api/v1/customer/entitlements/externalNetwork/{externalNetwork}/advisors', self.list_entitlements)
+        app.router.add_delete('/api/v1/customer/entitlements/{symphonyId}/entitlementType/{externalNetwork}', self.delete_entitlement)
+        app.router.add_post('/api/v2/customer/entitlements', self.add_entitlement)
+        app.router.add_get('/api/v2/customer/advisor/entitlements', self.get_entitlement)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        # Port 0 lets the OS pick a free port
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @web.middleware
+    async def inject_faults(self, request, handler):
+        self.calls[request.match_info.route.resource.canonical if request.match_info.route.resource else request.path] += 1
+        await asyncio.sleep(max(0, random.gauss(self.latency, self.jitter)))
+
+        if random.random() < self.throttle_rate:
+            return web.json_response({'status': 429, 'title': 'Too Many Requests'}, status=429, headers={'Retry-After': '0'})
+        if random.random() < self.error_rate:
+            return web.json_response({'status': 503, 'title': 'Service Unavailable'}, status=503)
+        return await handler(request)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def not_found(self, message):
+        return web.json_response({'status': 404, 'title': 'Not Found', 'message': message}, status=404)
+
+    async def list_permission(self, request):
+        return web.json_response({'permissions': [{'permissionName': p} for p in self.PERMISSIONS]})
+
+    async def get_advisor_permission(self, request):
+        permissions = self.advisor_permissions.get(request.match_info['advisorEmail'].lower())
+        if permissions is None:
+            return self.not_found('Advisor not found')
+        return web.json_response({'permissions': [{'permissionName': p} for p in permissions]})
+
+    async def add_permission(self, request):
+        body = await request.json()
+        permissions = self.advisor_permissions.setdefault(request.match_info['advisorEmail'].lower(), [])
+        if body['permissionName'] not in permissions:
+            permissions.append(body['permissionName'])
+        return web.json_response({'permissions': [{'permissionName': p} for p in permissions]}, status=201)
+
+    async def delete_permission(self, request):
+        permissions = self.advisor_permissions.get(request.match_info['advisorEmail'].lower(), [])
+        if request.match_info['permissionName'] in permissions:
+            permissions.remove(request.match_info['permissionName'])
+        return web.Response(status=204)
+
+    async def list_entitlements(self, request):
+        keys = list(self.entitlements.keys())
+        offset = int(request.query.get('cursor', 0))
+        page = keys[offset:offset + self.page_size]
+        pagination = {
+            'next': f'?cursor={offset + self.page_size}' if offset + self.page_size < len(keys) else None,
+            'previous': f'?cursor={max(offset - self.page_size, 0)}' if offset > 0 else None
+        }
+        return web.json_response({'entitlements': [self.entitlements[k] for k in page], 'pagination': pagination})
+
+    async def delete_entitlement(self, request):
+        if self.entitlements.pop(request.match_info['symphonyId'], None) is None:
+            return self.not_found('Entitlement not found')
+        return web.Response(status=204)
+
+    async def add_entitlement(self, request):
+        body = await request.json()
+        entitlement = {'symphonyId': str(body['symphonyId']), 'externalNetwork': body['externalNetwork']}
+        self.entitlements[entitlement['symphonyId']] = entitlement
+        return web.json_response(entitlement, status=201)
+
+    async def get_entitlement(self, request):
+        entitlement = self.entitlements.get(request.query.get('advisorSymphonyId', ''))
+        if entitlement is None:
+            return self.not_found('Entitlement not found')
+        return web.json_response(entitlement)
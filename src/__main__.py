@@ -9,10 +9,25 @@ from symphony.bdk.core.symphony_bdk import SymphonyBdk
 from symphony.bdk.gen.agent_model.v4_initiator import V4Initiator
 from symphony.bdk.gen.agent_model.v4_message_sent import V4MessageSent
 
-from .activities_main import MainCommandActivity, RestartMainFormReplyActivity, HelpCommand
-from .activities_entitlement import EntitlementsMainMenuFormReplyActivity, EntitlementsDeleteFormReplyActivity, EntitlementsAddFormReplyActivity, EntitlementsSearchFormReplyActivity
-from .activities_permissions import PermissionsMainMenuFormReplyActivity, PermissionsViewEditFormReplyActivity, PermissionsEditUserFormReplyActivity, PermissionsSearchFormReplyActivity
-from .client.connect_client import ConnectApiClient
+from .activities_main import MainCommandActivity, RestartMainFormReplyActivity, HelpCommand, StatsCommand
+from .activities_entitlement import EntitlementsMainMenuFormReplyActivity, EntitlementsDeleteFormReplyActivity, EntitlementsAddFormReplyActivity, BulkAddEntitlementsCommandActivity, EntitlementsExportFormReplyActivity, EntitlementsSearchFormReplyActivity
+from .activities_status import UserStatusCommandActivity
+from .activities_permissions import PermissionsMainMenuFormReplyActivity, PermissionsRefreshCatalogFormReplyActivity, PermissionsViewEditFormReplyActivity, PermissionsEditUserFormReplyActivity, PermissionsBulkEditFormReplyActivity, PermissionsBulkApplyFormReplyActivity, PermissionsSearchFormReplyActivity
+from .client.connect_client import AsyncConnectApiClient
+from .bot_settings import BotSettings
+from .bulk_entitlements import BulkEntitlementAdder
+from .chunked_messages import ChunkedMessageSender
+from .entitlement_export import EntitlementExporter
+from .entitlement_index import EntitlementIndex
+from .log_queue import QueueLogging
+from .metrics import InstrumentedService, MetricsRegistry, MetricsServer
+from .page_prefetcher import EntitlementPagePrefetcher
+from .permission_service import PermissionService
+from .templates import TemplateRegistry
+from .tracing import ActivityTracer
+from .user_cache import UserProfileCache
+from .user_resolver import UserResolver
+from .warmup import StartupWarmup
 
 # Configure logging
 current_dir = Path(__file__).parent.parent
@@ -21,35 +36,116 @@ logging.config.fileConfig(logging_conf, disable_existing_loggers=False)
 
 
 async def run():
-    config = BdkConfigLoader.load_from_file(Path.joinpath(current_dir, 'resources', 'config.yaml'))
+    config_path = Path.joinpath(current_dir, 'resources', 'config.yaml')
+    config = BdkConfigLoader.load_from_file(config_path)
+    settings = BotSettings.load_from_file(config_path)
 
     # Check external network is configured
     if config.context is None:
         logging.error("ERROR: No external network configured in config file")
         exit(1)
 
+    # Write logs from a background thread, with high-volume DEBUG lines rate limited per call site
+    log_queue = QueueLogging(settings.get('logging', 'debugRate', QueueLogging.DEFAULT_DEBUG_RATE),
+                             settings.get('logging', 'debugBurst', QueueLogging.DEFAULT_DEBUG_BURST))
+    log_queue.start()
+
+    # Per activity timing traces, written to traces.jsonl
+    tracer = ActivityTracer(settings.get('tracing', 'slowThreshold', ActivityTracer.DEFAULT_SLOW_THRESHOLD),
+                            settings.get('tracing', 'enabled', True))
+    metrics = MetricsRegistry()
+    metrics_port = settings.get('metrics', 'port')
+    metrics_server = MetricsServer(metrics, metrics_port, settings.get('metrics', 'host', MetricsServer.DEFAULT_HOST)) if metrics_port else None
+
     # Init Conenct API Client
-    connect_client = ConnectApiClient(config)
-
-    async with SymphonyBdk(config) as bdk:
-        datafeed_loop = bdk.datafeed()
-        datafeed_loop.subscribe(MessageListener())
-
-        activities = bdk.activities()
-        activities.register(MainCommandActivity(bdk.messages(), config))
-        activities.register(RestartMainFormReplyActivity(bdk.messages(), config))
-        activities.register(HelpCommand(bdk.messages()))
-        activities.register(EntitlementsMainMenuFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(EntitlementsDeleteFormReplyActivity(bdk.messages(), connect_client))
-        activities.register(EntitlementsAddFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(EntitlementsSearchFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(PermissionsMainMenuFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(PermissionsViewEditFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(PermissionsEditUserFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-        activities.register(PermissionsSearchFormReplyActivity(bdk.messages(), bdk.users(), connect_client))
-
-        # Start the datafeed read loop
-        await datafeed_loop.start()
+    connect_client = AsyncConnectApiClient(config, metrics)
+    permission_service = PermissionService(connect_client, config)
+    entitlement_index = EntitlementIndex(connect_client, config)
+
+    # Templates are compiled by the warm-up below
+    templates = TemplateRegistry(auto_reload=settings.get('templates', 'autoReload', False),
+                                 bytecode_cache_dir=settings.get('templates', 'bytecodeCacheDir'))
+
+    try:
+        async with SymphonyBdk(config) as bdk:
+            datafeed_loop = bdk.datafeed()
+            datafeed_loop.subscribe(MessageListener())
+
+            # Time every pod call made by the activities
+            messages = InstrumentedService(bdk.messages(), 'symphony', metrics)
+            users = InstrumentedService(bdk.users(), 'symphony', metrics)
+
+            # Shared Symphony user lookups and profile cache for all activities
+            user_cache = UserProfileCache(settings.get('userCache', 'maxSize', UserProfileCache.DEFAULT_MAX_SIZE),
+                                          settings.get('userCache', 'ttl', UserProfileCache.DEFAULT_TTL))
+            user_resolver = UserResolver(users, user_cache)
+            page_prefetcher = EntitlementPagePrefetcher(connect_client, user_resolver, entitlement_index)
+            exporter = EntitlementExporter(messages, user_resolver, connect_client)
+            chunked_sender = ChunkedMessageSender(messages, settings.get('messages', 'maxSize', ChunkedMessageSender.DEFAULT_MAX_SIZE))
+            bulk_adder = BulkEntitlementAdder(messages, templates, user_resolver, connect_client, entitlement_index,
+                                              settings.get('bulkAdd', 'concurrency', BulkEntitlementAdder.DEFAULT_CONCURRENCY))
+
+            activities = bdk.activities()
+            activities.register(tracer.instrument(MainCommandActivity(messages, templates, config)))
+            activities.register(tracer.instrument(RestartMainFormReplyActivity(messages, templates, config)))
+            activities.register(tracer.instrument(HelpCommand(messages, templates)))
+            activities.register(tracer.instrument(StatsCommand(messages, templates, metrics)))
+            activities.register(tracer.instrument(UserStatusCommandActivity(messages, templates, config, user_resolver, permission_service, entitlement_index)))
+            activities.register(tracer.instrument(EntitlementsMainMenuFormReplyActivity(messages, templates, user_resolver, connect_client, page_prefetcher)))
+            activities.register(tracer.instrument(EntitlementsDeleteFormReplyActivity(messages, connect_client, entitlement_index)))
+            activities.register(tracer.instrument(EntitlementsAddFormReplyActivity(messages, bulk_adder)))
+            activities.register(tracer.instrument(BulkAddEntitlementsCommandActivity(messages, config, bulk_adder)))
+            activities.register(tracer.instrument(EntitlementsExportFormReplyActivity(messages, exporter)))
+            activities.register(tracer.instrument(EntitlementsSearchFormReplyActivity(messages, templates, user_resolver, connect_client, entitlement_index)))
+            activities.register(tracer.instrument(PermissionsMainMenuFormReplyActivity(messages, templates, user_resolver, connect_client, permission_service, page_prefetcher, chunked_sender)))
+            activities.register(tracer.instrument(PermissionsRefreshCatalogFormReplyActivity(messages, permission_service)))
+            activities.register(tracer.instrument(PermissionsViewEditFormReplyActivity(messages, templates, user_resolver, connect_client, permission_service)))
+            activities.register(tracer.instrument(PermissionsEditUserFormReplyActivity(messages, templates, user_resolver, connect_client, permission_service)))
+            activities.register(tracer.instrument(PermissionsBulkEditFormReplyActivity(messages, templates, user_resolver, permission_service)))
+            activities.register(tracer.instrument(PermissionsBulkApplyFormReplyActivity(messages, templates, permission_service)))
+            activities.register(tracer.instrument(PermissionsSearchFormReplyActivity(messages, templates, user_resolver, connect_client, permission_service, entitlement_index, chunked_sender)))
+
+            metrics.register_collector(lambda: cache_counters(connect_client, user_cache, page_prefetcher, permission_service))
+            if metrics_server is not None:
+                await metrics_server.start()
+
+            # Sign tokens, open connections, fetch catalogs and compile templates before serving
+            if settings.get('warmup', 'enabled', True):
+                warmup = StartupWarmup(config, connect_client, permission_service, templates, bdk.sessions(),
+                                       settings.get('warmup', 'timeout', StartupWarmup.DEFAULT_TIMEOUT))
+                await warmup.run()
+
+            # Crawl entitlements in the background, searches fall back to Connect until built
+            entitlement_index.start()
+
+            # Start the datafeed read loop
+            await datafeed_loop.start()
+    finally:
+        # Release pooled Connect connections on shutdown
+        await entitlement_index.stop()
+        await connect_client.close()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        log_queue.stop()
+
+
+def cache_counters(connect_client, user_cache, page_prefetcher, permission_service):
+    # Counters kept by the caches themselves, read on every scrape
+    user_stats = user_cache.stats()
+    counters = {
+        ('cache_hits_total', (('cache', 'user_profiles'),)): user_stats['hits'],
+        ('cache_misses_total', (('cache', 'user_profiles'),)): user_stats['misses'],
+        ('cache_evictions_total', (('cache', 'user_profiles'),)): user_stats['evictions'],
+        ('cache_hits_total', (('cache', 'entitlement_pages'),)): page_prefetcher.hits,
+        ('cache_misses_total', (('cache', 'entitlement_pages'),)): page_prefetcher.misses,
+        ('coalesced_calls_total', ()): connect_client.get_coalesced_calls()
+    }
+    for name in permission_service.hits:
+        counters[('cache_hits_total', (('cache', f'permissions_{name}'),))] = permission_service.hits[name]
+        counters[('cache_misses_total', (('cache', f'permissions_{name}'),))] = permission_service.misses[name]
+    for externalNetwork, rate_limiter in connect_client.rate_limiters.items():
+        counters[('throttled_total', (('network', externalNetwork),))] = rate_limiter.throttled_count
+    return counters
 
 
 class MessageListener(RealTimeEventListener):
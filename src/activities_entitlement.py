@@ -1,21 +1,30 @@
+import base64
 import re
 
-from jinja2 import Template
-
+from symphony.bdk.core.activity.command import CommandActivity, CommandContext
 from symphony.bdk.core.activity.form import FormReplyActivity, FormReplyContext
+from symphony.bdk.core.config.model.bdk_config import BdkConfig
 from symphony.bdk.core.service.message.message_service import MessageService
-from symphony.bdk.core.service.user.user_service import UserService
-from .client.connect_client import ConnectApiClient
+from .activities_main import bot_command_args
+from .bulk_entitlements import BulkEntitlementAdder
+from .client.connect_client import AsyncConnectApiClient
+from .entitlement_export import EntitlementExporter
+from .entitlement_index import EntitlementIndex
+from .page_prefetcher import EntitlementPagePrefetcher
+from .templates import TemplateRegistry
+from .tracing import annotate
+from .user_resolver import UserResolver
 
 
 class EntitlementsMainMenuFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, page_prefetcher: EntitlementPagePrefetcher):
         self._messages = messages
-        self._users = users
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = Template(open('resources/entitlements_add.jinja2').read(), autoescape=True)
+        self.page_prefetcher = page_prefetcher
+        self.templates = templates
         self.action = None
 
     def matches(self, context: FormReplyContext) -> bool:
@@ -25,11 +34,11 @@ class EntitlementsMainMenuFormReplyActivity(FormReplyActivity):
     async def on_activity(self, context: FormReplyContext):
         self.action = context.form_values["action"]
         if self.action == "add_entitlements":
-            self.template = Template(open('resources/entitlements_add.jinja2').read(), autoescape=True)
-            message = self.template.render(externalNetwork=context.form_values["externalNetwork"])
+            template = self.templates.get('entitlements_add.jinja2')
+            message = template.render(externalNetwork=context.form_values["externalNetwork"])
         elif self.action == "search_entitlements":
-            self.template = Template(open('resources/entitlements_search.jinja2').read(), autoescape=True)
-            message = self.template.render(externalNetwork=context.form_values["externalNetwork"])
+            template = self.templates.get('entitlements_search.jinja2')
+            message = template.render(externalNetwork=context.form_values["externalNetwork"])
         else:
             if self.action == "next_page":
                 page_cursor = context.form_values['next_cursor']
@@ -37,42 +46,34 @@ class EntitlementsMainMenuFormReplyActivity(FormReplyActivity):
                 page_cursor = context.form_values['prev_cursor']
             else:
                 page_cursor = ''
-            self.template = Template(open('resources/entitlements_view_delete.jinja2').read(), autoescape=True)
-            userList, next_cursor, prev_cursor = self.getConnectEntitledUsers(context.form_values["externalNetwork"], page_cursor)
+            template = self.templates.get('entitlements_view_delete.jinja2')
+            userList, next_cursor, prev_cursor = await self.getConnectEntitledUsers(context.form_values["externalNetwork"], page_cursor)
             symphony_user_profiles = await self.getSymphonyUserDetails(userList)
-            message = self.template.render(externalNetwork=context.form_values["externalNetwork"], userList=userList, next_cursor=next_cursor, prev_cursor=prev_cursor, symphony_user_profiles=symphony_user_profiles)
+            annotate(rows=len(userList))
+            message = template.render(externalNetwork=context.form_values["externalNetwork"], userList=userList, next_cursor=next_cursor, prev_cursor=prev_cursor, symphony_user_profiles=symphony_user_profiles)
 
         await self._messages.send_message(context.source_event.stream.stream_id, message)
 
-    def getConnectEntitledUsers(self, externalNetwork, page_cursor):
-        status, result, next_cursor, prev_cursor = self.connect_client.list_entitlements(externalNetwork, page_cursor)
-        if status == 'OK':
-            if 'entitlements' in result and len(result['entitlements']) > 0:
-                return result['entitlements'], next_cursor, prev_cursor
+    async def getConnectEntitledUsers(self, externalNetwork, page_cursor):
+        userList, next_cursor, prev_cursor = await self.page_prefetcher.get_page(externalNetwork, page_cursor)
+        if len(userList) > 0:
+            # Load the following page while this one is displayed
+            self.page_prefetcher.prefetch(externalNetwork, next_cursor)
+            return userList, next_cursor, prev_cursor
 
         return [], '', ''
 
     async def getSymphonyUserDetails(self, userList):
-        userIds = []
-        resultDict = dict()
-        for u1 in userList:
-            userIds.append(u1['symphonyId'])
-
-        output = await self._users.list_users_by_ids(user_ids=userIds)
-
-        if 'users' in output:
-            for u2 in output['users']:
-                resultDict[str(u2['id'])] = u2
-
-        return resultDict
+        return await self._user_resolver.get_user_profiles([u.symphonyId for u in userList])
 
 
 class EntitlementsDeleteFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, connect_client: AsyncConnectApiClient, entitlement_index: EntitlementIndex):
         self._messages = messages
         self.connect_client = connect_client
+        self.entitlement_index = entitlement_index
 
     def matches(self, context: FormReplyContext) -> bool:
         return context.form_id == "entitlements-view-delete-form" \
@@ -80,8 +81,9 @@ class EntitlementsDeleteFormReplyActivity(FormReplyActivity):
 
     async def on_activity(self, context: FormReplyContext):
         symphonyId = re.search("(del_)(.+)", context.form_values["action"]).group(2)
-        status, result = self.connect_client.delete_entitlement(context.form_values["externalNetwork"], symphonyId)
+        status, result = await self.connect_client.delete_entitlement(context.form_values["externalNetwork"], symphonyId)
         if status == 'OK':
+            self.entitlement_index.remove(context.form_values["externalNetwork"], symphonyId)
             await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>Successfully removed user from {context.form_values['externalNetwork']} entitlement</messageML>")
         else:
             await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>Error removing user!</messageML>")
@@ -90,110 +92,116 @@ class EntitlementsDeleteFormReplyActivity(FormReplyActivity):
 class EntitlementsAddFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, bulk_adder: BulkEntitlementAdder):
         self._messages = messages
-        self._users = users
-        self.connect_client = connect_client
-        self.template = None
+        self.bulk_adder = bulk_adder
 
     def matches(self, context: FormReplyContext) -> bool:
         return context.form_id == "entitlements-add-form" \
-            and context.form_values["userlist"] \
+            and (context.form_values.get("userlist") or context.form_values.get("bulk_users", "").strip()) \
             and context.form_values["action"] != "restart_main"
 
     async def on_activity(self, context: FormReplyContext):
-        userList = context.form_values["userlist"]
+        userList = [str(symphonyId) for symphonyId in context.form_values.get("userlist") or []]
+        userList += BulkEntitlementAdder.parse_identifiers(context.form_values.get("bulk_users", ""))
         externalNetwork = context.form_values["externalNetwork"]
-        user_dict = dict()
-        result_dict = dict()
-
-        for symphonyId in userList:
-            # Get Symphony User Details
-            try:
-                output = await self._users.list_users_by_ids(user_ids=[symphonyId])
-                if 'users' in output:
-                    userDet = output['users'][0]
-                    user_dict[symphonyId] = userDet
-                else:
-                    user_dict[symphonyId] = {
-                        'display_name': symphonyId,
-                        'email_address': ''
-                    }
-                    result_dict[symphonyId] = "ERROR: Invalid User"
-
-            except:
-                user_dict[symphonyId] = {
-                    'display_name': symphonyId,
-                    'email_address': ''
-                }
-                result_dict[symphonyId] = "ERROR: Invalid User"
-                continue
-
-            # Call Connect Add Entitlement
-            status, result = self.connect_client.add_entitlement(externalNetwork, symphonyId)
-            if status == 'OK':
-                result_dict[symphonyId] = 'User successfully added'
-            else:
-                result_dict[symphonyId] = result
 
-        # Render and send result
-        self.template = Template(open('resources/entitlements_add_result.jinja2').read(), autoescape=True)
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"], user_dict=user_dict, result_dict = result_dict)
-        await self._messages.send_message(context.source_event.stream.stream_id, message)
+        await self.bulk_adder.add_users(context.source_event.stream.stream_id, externalNetwork, list(dict.fromkeys(userList)))
+
+
+class BulkAddEntitlementsCommandActivity(CommandActivity):
+    """@bot-name /bulkadd NETWORK with a CSV attachment of emails or Symphony IDs
+    """
+    command_name = "/bulkadd"
+
+    def __init__(self, messages: MessageService, config: BdkConfig, bulk_adder: BulkEntitlementAdder):
+        super().__init__()
+        self._messages = messages
+        self._config = config
+        self.bulk_adder = bulk_adder
+
+    def matches(self, context: CommandContext) -> bool:
+        return bot_command_args(context, self.command_name) is not None
+
+    async def on_activity(self, context: CommandContext):
+        args = bot_command_args(context, self.command_name)
+        externalNetwork = args[0] if len(args) > 0 else None
+        if externalNetwork not in self._config.context:
+            networks = ", ".join(self._config.context.keys())
+            await self._messages.send_message(context.stream_id, f"<messageML>Usage: /bulkadd NETWORK with a CSV file attached, where NETWORK is one of {networks}</messageML>")
+            return
+
+        attachments = context.source_event.message.attachments or []
+        userList = []
+        for attachment in attachments:
+            if attachment.name.lower().endswith('.csv'):
+                content = await self._messages.get_attachment(context.stream_id, context.message_id, attachment.id)
+                userList += BulkEntitlementAdder.parse_csv(base64.urlsafe_b64decode(content).decode('utf-8-sig'))
+
+        if len(userList) == 0:
+            await self._messages.send_message(context.stream_id, f"<messageML>No emails or Symphony IDs found in the attached CSV file!</messageML>")
+            return
+
+        await self.bulk_adder.add_users(context.stream_id, externalNetwork, list(dict.fromkeys(userList)))
+
+
+class EntitlementsExportFormReplyActivity(FormReplyActivity):
+
+    def __init__(self, messages: MessageService, exporter: EntitlementExporter):
+        self._messages = messages
+        self.exporter = exporter
+
+    def matches(self, context: FormReplyContext) -> bool:
+        return context.form_id == "main-menu-form" \
+            and context.form_values["action"] == "export_entitlements"
+
+    async def on_activity(self, context: FormReplyContext):
+        externalNetwork = context.form_values["externalNetwork"]
+        await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>Exporting {externalNetwork} entitlements and permissions, the CSV file will be posted here when ready</messageML>")
+        self.exporter.start(context.source_event.stream.stream_id, externalNetwork)
 
 
 class EntitlementsSearchFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, entitlement_index: EntitlementIndex):
         self._messages = messages
-        self._users = users
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = None
+        self.templates = templates
+        self.entitlement_index = entitlement_index
 
     def matches(self, context: FormReplyContext) -> bool:
         return context.form_id == "entitlements-search-form" \
-            and context.form_values["userlist"] \
+            and (context.form_values.get("userlist") or (context.form_values.get("filter") or "").strip()) \
             and context.form_values["action"] != "restart_main"
 
     async def on_activity(self, context: FormReplyContext):
-        userList = context.form_values["userlist"]
+        userList = context.form_values.get("userlist")
         externalNetwork = context.form_values["externalNetwork"]
-        user_dict = dict()
-        result_dict = dict()
-
-        for symphonyId in userList:
-            # Get Symphony User Details
-            try:
-                output = await self._users.list_users_by_ids(user_ids=[symphonyId])
-                if 'users' in output:
-                    userDet = output['users'][0]
-                    user_dict[symphonyId] = userDet
-
-                    # Check user Entitlement status
-                    status, result = self.connect_client.get_entitlement(externalNetwork, symphonyId)
-                    if status == 'OK':
-                        result_dict[symphonyId] = result
-                    else:
-                        result_dict[symphonyId] = "ERROR"
-                else:
-                    user_dict[symphonyId] = {
-                        'display_name': symphonyId,
-                        'email_address': ''
-                    }
-                    result_dict[symphonyId] = "ERROR"
-
-            except:
-                user_dict[symphonyId] = {
-                    'display_name': symphonyId,
-                    'email_address': ''
-                }
-                result_dict[symphonyId] = "ERROR"
-                continue
+        if not userList:
+            await self.filterEntitlements(context, externalNetwork, context.form_values["filter"].strip())
+            return
+
+        # Get Symphony User Details and their entitlement status
+        user_profiles = await self._user_resolver.resolve_users(userList)
+        result_dict, user_dict = await self.entitlement_index.entitled_status(externalNetwork, user_profiles)
 
         # Render and send result
-        self.template = Template(open('resources/entitlements_view_delete.jinja2').read(), autoescape=True)
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"], userDict=result_dict,
+        annotate(rows=len(userList))
+        template = self.templates.get('entitlements_view_delete.jinja2')
+        message = template.render(externalNetwork=context.form_values["externalNetwork"], userDict=result_dict,
                                        next_cursor='', prev_cursor='',
                                        symphony_user_profiles=user_dict)
-        await self._messages.send_message(context.source_event.stream.stream_id, message)
\ No newline at end of file
+        await self._messages.send_message(context.source_event.stream.stream_id, message)
+    async def filterEntitlements(self, context: FormReplyContext, externalNetwork, filter_text):
+        if not self.entitlement_index.is_ready(externalNetwork):
+            await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>The {externalNetwork} entitlement list is still loading, please try again shortly or select users instead</messageML>")
+            return
+
+        userList, symphony_user_profiles, total_matches = await self.entitlement_index.filter_entitlements(externalNetwork, filter_text, self._user_resolver)
+        annotate(rows=len(userList), matches=total_matches)
+        template = self.templates.get('entitlements_view_delete.jinja2')
+        message = template.render(externalNetwork=externalNetwork, userList=userList, next_cursor='', prev_cursor='',
+                                  symphony_user_profiles=symphony_user_profiles, filter_text=filter_text, total_matches=total_matches)
+        await self._messages.send_message(context.source_event.stream.stream_id, message)
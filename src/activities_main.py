@@ -1,42 +1,56 @@
-from jinja2 import Template
+import re
 
 from symphony.bdk.core.config.model.bdk_config import BdkConfig
 from symphony.bdk.core.activity.command import SlashCommandActivity, CommandContext
 from symphony.bdk.core.activity.form import FormReplyActivity, FormReplyContext
 from symphony.bdk.core.service.message.message_service import MessageService
+from .metrics import MetricsRegistry
+from .templates import TemplateRegistry
+
+
+def bot_command_args(context: CommandContext, command_name):
+    # Arguments of a "@bot-name /command ..." message, None when the message is not that command.
+    # As with SlashCommandActivity, the bot must be @mentioned first so other bots' commands are ignored
+    if not context.bot_display_name:
+        return None
+    match = re.match(rf'\s*@{re.escape(context.bot_display_name)}\s+{re.escape(command_name)}(\s|$)', context.text_content)
+    if match is None:
+        return None
+    return context.text_content[match.end():].split()
+
 
 class MainCommandActivity(SlashCommandActivity):
     """@bot-name /start
     """
     command_name = "/start"
 
-    def __init__(self, messages: MessageService, config: BdkConfig):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, config: BdkConfig):
         super().__init__(self.command_name, True, self.show_main_menu, "Show Main Menu")
         self._messages = messages
         self._config = config
-        self.template = Template(open('resources/main_menu.jinja2').read(), autoescape=True)
+        self.templates = templates
 
     async def show_main_menu(self, context: CommandContext):
         # Get list of defined external networks from config
         extNetwork_list = list(self._config.context.keys())
-        message = self.template.render(extNetwork_list=extNetwork_list)
+        message = self.templates.render('main_menu.jinja2', extNetwork_list=extNetwork_list)
         await self._messages.send_message(context.stream_id, message)
 
 
 class RestartMainFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, config: BdkConfig):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, config: BdkConfig):
         self._messages = messages
         self._config = config
-        self.template = Template(open('resources/main_menu.jinja2').read(), autoescape=True)
+        self.templates = templates
 
     def matches(self, context: FormReplyContext) -> bool:
         return context.form_values["action"] == "restart_main"
 
     async def on_activity(self, context: FormReplyContext):
         extNetwork_list = list(self._config.context.keys())
-        message = self.template.render(extNetwork_list=extNetwork_list)
+        message = self.templates.render('main_menu.jinja2', extNetwork_list=extNetwork_list)
         await self._messages.send_message(context.source_event.stream.stream_id, message)
 
 
@@ -47,12 +61,29 @@ class HelpCommand(SlashCommandActivity):
       - "@{bot_display name} /help"
     """
 
-    def __init__(self, messages: MessageService):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry):
         super().__init__("/help", True, None, "List available commands")
         self._messages = messages
-        self.template = Template(open('resources/help_menu.jinja2').read(), autoescape=True)
+        self.templates = templates
 
     async def on_activity(self, context: CommandContext):
         bot_displayname = "@" + context.bot_display_name
-        message = self.template.render(bot_displayname=bot_displayname)
-        await self._messages.send_message(context.stream_id, message)
\ No newline at end of file
+        message = self.templates.render('help_menu.jinja2', bot_displayname=bot_displayname)
+        await self._messages.send_message(context.stream_id, message)
+
+
+class StatsCommand(SlashCommandActivity):
+    """@bot-name /stats
+    """
+    command_name = "/stats"
+
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, metrics: MetricsRegistry):
+        super().__init__(self.command_name, True, self.show_stats, "Show call latency and cache statistics")
+        self._messages = messages
+        self.templates = templates
+        self.metrics = metrics
+
+    async def show_stats(self, context: CommandContext):
+        endpoints, counters = self.metrics.summary()
+        message = self.templates.render('stats.jinja2', endpoints=endpoints, counters=counters)
+        await self._messages.send_message(context.stream_id, message)
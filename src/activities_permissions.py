@@ -1,21 +1,52 @@
 import re
 
-from jinja2 import Template
-
 from symphony.bdk.core.activity.form import FormReplyActivity, FormReplyContext
 from symphony.bdk.core.service.message.message_service import MessageService
-from symphony.bdk.core.service.user.user_service import UserService
-from .client.connect_client import ConnectApiClient
+from .chunked_messages import ChunkedMessageSender
+from .client.connect_client import AsyncConnectApiClient
+from .client.models import permission_names
+from .entitlement_index import EntitlementIndex
+from .page_prefetcher import EntitlementPagePrefetcher
+from .permission_service import PermissionService
+from .templates import TemplateRegistry
+from .tracing import annotate
+from .user_resolver import UserResolver
+
+
+def get_form_list(form_values, name):
+    # Checkbox groups are submitted as a list, or a single value when only one is ticked
+    if name not in form_values or form_values[name] is None:
+        return []
+    if isinstance(form_values[name], list):
+        return form_values[name]
+    return [form_values[name]]
+
+
+def send_permission_matrix(chunked_sender, stream_id, template, connect_permissions, rows, **kwargs):
+    # Large matrices are split over several messages, rows is the list (page view) or
+    # dict items (search view) of entitled users to show
+    def render(chunk, part, parts):
+        if isinstance(rows, dict):
+            return template.render(connect_entitled_dict=dict(chunk), connect_permissions=connect_permissions, part=part, parts=parts, **kwargs)
+        return template.render(connect_entitled_users=chunk, connect_permissions=connect_permissions, part=part, parts=parts, **kwargs)
+
+    # Rough size of a row and of the headers, refined from the first rendered part
+    row_size = 600 + 45 * len(connect_permissions)
+    base_size = ChunkedMessageSender.DEFAULT_BASE_SIZE + 120 * len(connect_permissions)
+    return chunked_sender.send(stream_id, list(rows.items()) if isinstance(rows, dict) else rows, render, row_size, base_size)
 
 
 class PermissionsMainMenuFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, permission_service: PermissionService, page_prefetcher: EntitlementPagePrefetcher, chunked_sender: ChunkedMessageSender):
         self._messages = messages
-        self._users = users
+        self.chunked_sender = chunked_sender
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = None
+        self.permission_service = permission_service
+        self.page_prefetcher = page_prefetcher
+        self.templates = templates
         self.action = None
 
     def matches(self, context: FormReplyContext) -> bool:
@@ -23,12 +54,12 @@ class PermissionsMainMenuFormReplyActivity(FormReplyActivity):
             and context.form_values["action"] in ("view_edit_permissions", "search_permissions","next_page", "prev_page")
 
     async def on_activity(self, context: FormReplyContext):
-        self.template = Template(open('resources/permissions_view_edit.jinja2').read(), autoescape=True)
+        template = self.templates.get('permissions_view_edit.jinja2')
         externalNetwork = context.form_values["externalNetwork"]
         self.action = context.form_values["action"]
         if self.action == "search_permissions":
-            self.template = Template(open('resources/permissions_search.jinja2').read(), autoescape=True)
-            message = self.template.render(externalNetwork=context.form_values["externalNetwork"])
+            template = self.templates.get('permissions_search.jinja2')
+            message = template.render(externalNetwork=context.form_values["externalNetwork"])
             await self._messages.send_message(context.source_event.stream.stream_id, message)
             return
         elif self.action == "next_page":
@@ -37,85 +68,61 @@ class PermissionsMainMenuFormReplyActivity(FormReplyActivity):
             page_cursor = context.form_values['prev_cursor']
         else:
             page_cursor = ''
-        connect_permissions = self.getConnectPermissions(externalNetwork)
-        connect_entitled_users, next_cursor, prev_cursor = self.getConnectEntitledUsers(externalNetwork, page_cursor)
+        connect_permissions = await self.permission_service.get_permission_catalog(externalNetwork)
+        connect_entitled_users, next_cursor, prev_cursor = await self.getConnectEntitledUsers(externalNetwork, page_cursor)
         symphony_user_profiles = await self.getSymphonyUserDetails(connect_entitled_users)
-        entitled_users_permissions = dict()
-
-        # Loop through Entitled Users
-        for user in connect_entitled_users:
-            symphonyId = user['symphonyId']
-
-            # Get Connect permissions
-            advisorEmail = symphony_user_profiles[symphonyId]['email_address']
-            entitled_users_permissions[symphonyId] = self.getAdvisorPermission(externalNetwork, advisorEmail)
-
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"], connect_permissions=connect_permissions,
-                                      connect_entitled_users=connect_entitled_users, symphony_user_profiles=symphony_user_profiles, entitled_users_permissions=entitled_users_permissions,
-                                       next_cursor=next_cursor, prev_cursor=prev_cursor)
-
-        await self._messages.send_message(context.source_event.stream.stream_id, message)
-
-    def getConnectEntitledUsers(self, externalNetwork, page_cursor):
-        status, result, next_cursor, prev_cursor = self.connect_client.list_entitlements(externalNetwork, page_cursor)
-        if status == 'OK':
-            if 'entitlements' in result and len(result['entitlements']) > 0:
-                return result['entitlements'], next_cursor, prev_cursor
+        symphonyIds = [user.symphonyId for user in connect_entitled_users]
+        entitled_users_permissions = await self.permission_service.get_many_advisor_permissions(externalNetwork, symphonyIds, symphony_user_profiles)
+        annotate(rows=len(connect_entitled_users), permissions=len(connect_permissions))
+
+        parts = await send_permission_matrix(self.chunked_sender, context.source_event.stream.stream_id, template, connect_permissions, connect_entitled_users,
+                                             externalNetwork=context.form_values["externalNetwork"], symphony_user_profiles=symphony_user_profiles,
+                                             entitled_users_permissions=entitled_users_permissions, next_cursor=next_cursor, prev_cursor=prev_cursor)
+        annotate(parts=parts)
+
+    async def getConnectEntitledUsers(self, externalNetwork, page_cursor):
+        userList, next_cursor, prev_cursor = await self.page_prefetcher.get_page(externalNetwork, page_cursor)
+        if len(userList) > 0:
+            # Load the following page and its permissions while this one is displayed
+            self.page_prefetcher.prefetch(externalNetwork, next_cursor,
+                                          after=lambda users, profiles: self.permission_service.get_many_advisor_permissions(externalNetwork, [u.symphonyId for u in users], profiles))
+            return userList, next_cursor, prev_cursor
 
         return [], '', ''
 
-    def getConnectPermissions(self, externalNetwork):
-        status, result = self.connect_client.list_permission(externalNetwork)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
-
-        return []
-
-    def getAdvisorPermission(self, externalNetwork, advisorEmail):
-        status, result = self.connect_client.get_advisor_permission(externalNetwork, advisorEmail)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
+    async def getSymphonyUserDetails(self, userList):
+        return await self._user_resolver.get_user_profiles([u.symphonyId for u in userList])
 
-        return []
 
-    async def getSymphonyUserDetails(self, userList):
-        userIds = []
-        resultDict = dict()
-        for u1 in userList:
-            userIds.append(u1['symphonyId'])
 
-        output = await self._users.list_users_by_ids(user_ids=userIds)
 
-        if 'users' in output:
-            for u2 in output['users']:
-                resultDict[str(u2['id'])] = u2
+class PermissionsRefreshCatalogFormReplyActivity(FormReplyActivity):
 
-        return resultDict
+    def __init__(self, messages: MessageService, permission_service: PermissionService):
+        self._messages = messages
+        self.permission_service = permission_service
 
+    def matches(self, context: FormReplyContext) -> bool:
+        return context.form_id == "main-menu-form" \
+            and context.form_values["action"] == "refresh_permissions"
 
+    async def on_activity(self, context: FormReplyContext):
+        externalNetwork = context.form_values["externalNetwork"]
+        connect_permissions = await self.permission_service.refresh_permission_catalog(externalNetwork)
+        if len(connect_permissions) > 0:
+            await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>Reloaded {len(connect_permissions)} permissions for {externalNetwork}</messageML>")
+        else:
+            await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>Error reloading permissions for {externalNetwork}!</messageML>")
 
 
 class PermissionsViewEditFormReplyActivity(FormReplyActivity):
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, permission_service: PermissionService):
         self._messages = messages
-        self._users = users
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = None
+        self.permission_service = permission_service
+        self.templates = templates
         self.action = None
 
     def matches(self, context: FormReplyContext) -> bool:
@@ -123,63 +130,37 @@ class PermissionsViewEditFormReplyActivity(FormReplyActivity):
             and context.form_values["action"].startswith("edit_")
 
     async def on_activity(self, context: FormReplyContext):
-        self.template = Template(open('resources/permissions_edit_user.jinja2').read(), autoescape=True)
+        template = self.templates.get('permissions_edit_user.jinja2')
         symphonyId = re.search("(edit_)(.+)", context.form_values["action"]).group(2)
         externalNetwork = context.form_values["externalNetwork"]
 
         # Get Symphony User Details
-        try:
-            userDet = await self._users.list_users_by_ids(user_ids=[symphonyId])
-            if 'users' in userDet:
-                user_profile = userDet['users'][0]
-                advisorEmail = user_profile['email_address']
-        except:
+        user_profile = (await self._user_resolver.resolve_users([symphonyId]))[symphonyId]
+        if user_profile is None:
             message = f'<messageML>Fail to get user email for {symphonyId}</messageML>'
             await self._messages.send_message(context.source_event.stream.stream_id, message)
             return
 
-        connect_permissions = self.getConnectPermissions(externalNetwork)
-        user_permissions = self.getAdvisorPermission(externalNetwork, advisorEmail)
+        advisorEmail = user_profile.email_address
+        connect_permissions = await self.permission_service.get_permission_catalog(externalNetwork)
+        user_permissions = await self.getAdvisorPermission(externalNetwork, advisorEmail)
 
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"], connect_permissions=connect_permissions, user_permissions=user_permissions, user_profile=user_profile)
+        message = template.render(externalNetwork=context.form_values["externalNetwork"], connect_permissions=connect_permissions, user_permissions=user_permissions, user_profile=user_profile)
         await self._messages.send_message(context.source_event.stream.stream_id, message)
 
-    def getConnectPermissions(self, externalNetwork):
-        status, result = self.connect_client.list_permission(externalNetwork)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
-
-        return []
-
-    def getAdvisorPermission(self, externalNetwork, advisorEmail):
-        status, result = self.connect_client.get_advisor_permission(externalNetwork, advisorEmail)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
-
-        return []
+    async def getAdvisorPermission(self, externalNetwork, advisorEmail):
+        permissions = await self.permission_service.get_advisor_permissions(externalNetwork, advisorEmail)
+        return permissions if permissions is not None else []
 
 
 class PermissionsEditUserFormReplyActivity(FormReplyActivity):
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, permission_service: PermissionService):
         self._messages = messages
-        self._users = users
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = None
+        self.permission_service = permission_service
+        self.templates = templates
         self.action = None
 
     def matches(self, context: FormReplyContext) -> bool:
@@ -188,27 +169,15 @@ class PermissionsEditUserFormReplyActivity(FormReplyActivity):
             and context.form_values["action"] != "restart_main"
 
     async def on_activity(self, context: FormReplyContext):
-        self.template = Template(open('resources/permissions_edit_user_result.jinja2').read(), autoescape=True)
+        template = self.templates.get('permissions_edit_user_result.jinja2')
         externalNetwork = context.form_values["externalNetwork"]
         advisorEmail = context.form_values["advisorEmail"]
-        del_permission_list = []
-        add_permission_list = []
+        del_permission_list = get_form_list(context.form_values, "del_permissions")
+        add_permission_list = get_form_list(context.form_values, "new_permissions")
         permission_results = dict()
 
-        if "del_permissions" in context.form_values:
-            if isinstance(context.form_values["del_permissions"], list):
-                del_permission_list = context.form_values["del_permissions"]
-            else:
-                del_permission_list.append(context.form_values["del_permissions"])
-
-        if "new_permissions" in context.form_values:
-            if isinstance(context.form_values["new_permissions"], list):
-                add_permission_list = context.form_values["new_permissions"]
-            else:
-                add_permission_list.append(context.form_values["new_permissions"])
-
         for p1 in del_permission_list:
-            status, result = self.connect_client.delete_permission(externalNetwork, advisorEmail, p1)
+            status, result = await self.permission_service.delete_permission(externalNetwork, advisorEmail, p1)
             output = {
                 "status": status,
                 "action": "DELETE",
@@ -217,7 +186,7 @@ class PermissionsEditUserFormReplyActivity(FormReplyActivity):
             permission_results[p1] = output
 
         for p2 in add_permission_list:
-            status, result = self.connect_client.add_permission(externalNetwork, advisorEmail, p2)
+            status, result = await self.permission_service.add_permission(externalNetwork, advisorEmail, p2)
             output = {
                 "status": status,
                 "action": "ADD",
@@ -225,33 +194,85 @@ class PermissionsEditUserFormReplyActivity(FormReplyActivity):
             }
             permission_results[p2] = output
 
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"], advisorEmail=advisorEmail, permission_results=permission_results)
+        message = template.render(externalNetwork=context.form_values["externalNetwork"], advisorEmail=advisorEmail, permission_results=permission_results)
         await self._messages.send_message(context.source_event.stream.stream_id, message)
 
 
-    def addPermission(self, externalNetwork, advisorEmail, permissionName):
-        status, result = self.connect_client.add_permission(externalNetwork, advisorEmail, permissionName)
+    async def addPermission(self, externalNetwork, advisorEmail, permissionName):
+        status, result = await self.permission_service.add_permission(externalNetwork, advisorEmail, permissionName)
         if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
+            return permission_names(result)
 
         return []
 
 
+class PermissionsBulkEditFormReplyActivity(FormReplyActivity):
+
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, permission_service: PermissionService):
+        self._messages = messages
+        self._user_resolver = user_resolver
+        self.permission_service = permission_service
+        self.templates = templates
+
+    def matches(self, context: FormReplyContext) -> bool:
+        return context.form_id == "permissions-view-edit-form" \
+            and context.form_values["action"] == "bulk_edit"
+
+    async def on_activity(self, context: FormReplyContext):
+        externalNetwork = context.form_values["externalNetwork"]
+        selected_users = get_form_list(context.form_values, "selected_users")
+        if len(selected_users) == 0:
+            await self._messages.send_message(context.source_event.stream.stream_id, f"<messageML>No users selected!</messageML>")
+            return
+
+        user_profiles = await self._user_resolver.resolve_users(selected_users)
+        user_profiles = [p for p in user_profiles.values() if p is not None and p.email_address != '']
+        connect_permissions = await self.permission_service.get_permission_catalog(externalNetwork)
+        annotate(rows=len(user_profiles), permissions=len(connect_permissions))
+
+        template = self.templates.get('permissions_bulk_edit.jinja2')
+        message = template.render(externalNetwork=externalNetwork, connect_permissions=connect_permissions, user_profiles=user_profiles)
+        await self._messages.send_message(context.source_event.stream.stream_id, message)
+
+
+class PermissionsBulkApplyFormReplyActivity(FormReplyActivity):
+
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, permission_service: PermissionService):
+        self._messages = messages
+        self.permission_service = permission_service
+        self.templates = templates
+
+    def matches(self, context: FormReplyContext) -> bool:
+        return context.form_id == "permissions-bulk-edit-form" \
+            and ("new_permissions" in context.form_values or "del_permissions" in context.form_values) \
+            and context.form_values["action"] != "restart_main"
+
+    async def on_activity(self, context: FormReplyContext):
+        externalNetwork = context.form_values["externalNetwork"]
+        advisorEmails = [e.strip() for e in context.form_values["advisorEmails"].splitlines() if e.strip() != '']
+        del_permission_list = get_form_list(context.form_values, "del_permissions")
+        add_permission_list = get_form_list(context.form_values, "new_permissions")
+
+        permission_results = await self.permission_service.apply_permissions(externalNetwork, advisorEmails, add_permission_list, del_permission_list)
+        annotate(rows=len(advisorEmails), changes=len(add_permission_list) + len(del_permission_list))
+
+        template = self.templates.get('permissions_bulk_edit_result.jinja2')
+        message = template.render(externalNetwork=externalNetwork, permission_results=permission_results,
+                                  del_permissions=del_permission_list, add_permissions=add_permission_list)
+        await self._messages.send_message(context.source_event.stream.stream_id, message)
+
+
 class PermissionsSearchFormReplyActivity(FormReplyActivity):
     # Sends back the selected value on form submission
 
-    def __init__(self, messages: MessageService, users: UserService, connect_client: ConnectApiClient):
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver, connect_client: AsyncConnectApiClient, permission_service: PermissionService, entitlement_index: EntitlementIndex, chunked_sender: ChunkedMessageSender):
         self._messages = messages
-        self._users = users
+        self.chunked_sender = chunked_sender
+        self._user_resolver = user_resolver
         self.connect_client = connect_client
-        self.template = None
+        self.permission_service = permission_service
+        self.templates = templates
+        self.entitlement_index = entitlement_index
 
     def matches(self, context: FormReplyContext) -> bool:
         return context.form_id == "permissions-search-form" \
@@ -259,86 +280,21 @@ class PermissionsSearchFormReplyActivity(FormReplyActivity):
             and context.form_values["action"] != "restart_main"
 
     async def on_activity(self, context: FormReplyContext):
-        self.template = Template(open('resources/permissions_view_edit.jinja2').read(), autoescape=True)
+        template = self.templates.get('permissions_view_edit.jinja2')
         userList = context.form_values["userlist"]
         externalNetwork = context.form_values["externalNetwork"]
-        connect_permissions = self.getConnectPermissions(externalNetwork)
+        connect_permissions = await self.permission_service.get_permission_catalog(externalNetwork)
         connect_entitled_users, symphony_user_profiles = await self.getEntitledStatus(externalNetwork, userList)
-        entitled_users_permissions = dict()
-
-        # Loop through Entitled Users
-        for symphonyId, user in connect_entitled_users.items():
-            # Get Connect permissions
-            advisorEmail = symphony_user_profiles[symphonyId]['email_address']
-            entitled_users_permissions[symphonyId] = self.getAdvisorPermission(externalNetwork, advisorEmail)
+        symphonyIds = [symphonyId for symphonyId, user in connect_entitled_users.items() if user != 'ERROR']
+        entitled_users_permissions = await self.permission_service.get_many_advisor_permissions(externalNetwork, symphonyIds, symphony_user_profiles)
+        annotate(rows=len(userList), permissions=len(connect_permissions))
 
-        message = self.template.render(externalNetwork=context.form_values["externalNetwork"],
-                                       connect_permissions=connect_permissions,
-                                       connect_entitled_dict=connect_entitled_users,
-                                       symphony_user_profiles=symphony_user_profiles,
-                                       entitled_users_permissions=entitled_users_permissions,
-                                       next_cursor='', prev_cursor='')
-
-        await self._messages.send_message(context.source_event.stream.stream_id, message)
-
-    def getConnectPermissions(self, externalNetwork):
-        status, result = self.connect_client.list_permission(externalNetwork)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
-
-        return []
+        parts = await send_permission_matrix(self.chunked_sender, context.source_event.stream.stream_id, template, connect_permissions, connect_entitled_users,
+                                             externalNetwork=context.form_values["externalNetwork"], symphony_user_profiles=symphony_user_profiles,
+                                             entitled_users_permissions=entitled_users_permissions, next_cursor='', prev_cursor='')
+        annotate(parts=parts)
 
     async def getEntitledStatus(self, externalNetwork, userList):
-        connect_entitled_users = dict()
-        symphony_user_profiles = dict()
-        for symphonyId in userList:
-            # Get Symphony User Details
-            try:
-                output = await self._users.list_users_by_ids(user_ids=[symphonyId])
-                if 'users' in output:
-                    userDet = output['users'][0]
-                    symphony_user_profiles[symphonyId] = userDet
-
-                    # Check user Entitlement status
-                    status, result = self.connect_client.get_entitlement(externalNetwork, symphonyId)
-                    if status == 'OK':
-                        connect_entitled_users[symphonyId] = result
-                    else:
-                        connect_entitled_users[symphonyId] = "ERROR"
-                else:
-                    symphony_user_profiles[symphonyId] = {
-                        'display_name': symphonyId,
-                        'email_address': ''
-                    }
-                    connect_entitled_users[symphonyId] = "ERROR"
-
-            except:
-                symphony_user_profiles[symphonyId] = {
-                    'display_name': symphonyId,
-                    'email_address': ''
-                }
-                connect_entitled_users[symphonyId] = "ERROR"
-                continue
-
-        return connect_entitled_users, symphony_user_profiles
-
-    def getAdvisorPermission(self, externalNetwork, advisorEmail):
-        status, result = self.connect_client.get_advisor_permission(externalNetwork, advisorEmail)
-        if status == 'OK':
-            if 'permissions' in result and len(result['permissions']) > 0:
-                output = []
-                for p in result['permissions']:
-                    if isinstance(p, dict) and 'permissionName' in p:
-                        output.append(p['permissionName'])
-                    else:
-                        output.append(p)
-                return output
-
-        return []
+        # Get Symphony User Details and their entitlement status
+        user_profiles = await self._user_resolver.resolve_users(userList)
+        return await self.entitlement_index.entitled_status(externalNetwork, user_profiles)
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+
+from symphony.bdk.core.activity.command import CommandActivity, CommandContext
+from symphony.bdk.core.config.model.bdk_config import BdkConfig
+from symphony.bdk.core.service.message.message_service import MessageService
+from .activities_main import bot_command_args
+from .entitlement_index import EntitlementIndex
+from .permission_service import PermissionService
+from .templates import TemplateRegistry
+from .tracing import annotate
+from .user_resolver import UserResolver
+
+
+def mentioned_user_ids(context: CommandContext):
+    # User ids of the people @mentioned in the command, except the bot itself
+    try:
+        entities = json.loads(context.source_event.message.data or '{}')
+    except (AttributeError, ValueError):
+        return []
+
+    bot_user_id = str(getattr(context, 'bot_user_id', ''))
+    userIds = []
+    for entity in entities.values():
+        if isinstance(entity, dict) and entity.get('type') == 'com.symphony.user.mention':
+            for i in entity.get('id', []):
+                if i.get('type') == 'com.symphony.user.userId' and str(i.get('value')) != bot_user_id:
+                    userIds.append(str(i.get('value')))
+    return userIds
+
+
+class UserStatusCommandActivity(CommandActivity):
+    """@bot-name /status @user, email or Symphony ID - entitlements and permissions of a user on every network
+    """
+    command_name = "/status"
+
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, config: BdkConfig, user_resolver: UserResolver,
+                 permission_service: PermissionService, entitlement_index: EntitlementIndex):
+        super().__init__()
+        self._messages = messages
+        self._config = config
+        self._user_resolver = user_resolver
+        self.permission_service = permission_service
+        self.entitlement_index = entitlement_index
+        self.templates = templates
+
+    def matches(self, context: CommandContext) -> bool:
+        return bot_command_args(context, self.command_name) is not None
+
+    async def on_activity(self, context: CommandContext):
+        user_profile = await self.resolve_user(context)
+        if user_profile is None or user_profile.email_address == '':
+            await self._messages.send_message(context.stream_id, "<messageML>Usage: /status followed by an @mention, email or Symphony ID of a valid user</messageML>")
+            return
+
+        # Every network is queried at once, the reply waits for the slowest one only
+        externalNetworks = list(self._config.context.keys())
+        statuses = await asyncio.gather(*[self.getNetworkStatus(externalNetwork, user_profile) for externalNetwork in externalNetworks],
+                                        return_exceptions=True)
+        network_status = dict()
+        for externalNetwork, status in zip(externalNetworks, statuses):
+            if isinstance(status, Exception):
+                logging.error('Failed to get %s status of %s: %s', externalNetwork, user_profile.id, status)
+                status = {'entitled': None, 'permissions': None}
+            network_status[externalNetwork] = status
+        annotate(networks=len(externalNetworks))
+
+        message = self.templates.render('user_status.jinja2', user_profile=user_profile, network_status=network_status)
+        await self._messages.send_message(context.stream_id, message)
+
+    async def resolve_user(self, context: CommandContext):
+        userIds = mentioned_user_ids(context)
+        if len(userIds) > 0:
+            return (await self._user_resolver.get_user_profiles(userIds[:1])).get(userIds[0])
+
+        args = bot_command_args(context, self.command_name)
+        for arg in args:
+            if '@' in arg:
+                return (await self._user_resolver.get_user_profiles_by_emails([arg])).get(arg.lower())
+            if arg.isdigit():
+                return (await self._user_resolver.get_user_profiles([arg])).get(arg)
+        return None
+
+    async def getNetworkStatus(self, externalNetwork, user_profile):
+        entitled, permissions = await asyncio.gather(self.getEntitlement(externalNetwork, user_profile.id),
+                                                     self.permission_service.get_advisor_permissions(externalNetwork, user_profile.email_address))
+        return {'entitled': entitled, 'permissions': permissions if entitled else []}
+
+    async def getEntitlement(self, externalNetwork, symphonyId):
+        # As in the search activities, any error is reported as not entitled
+        return await self.entitlement_index.lookup(externalNetwork, symphonyId) is not None
@@ -0,0 +1,17 @@
+import yaml
+
+
+class BotSettings():
+    # Bot specific settings read from the optional connectBot section of config.yaml
+
+    def __init__(self, settings=None):
+        self.settings = settings or dict()
+
+    @classmethod
+    def load_from_file(cls, path):
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f) or dict()
+        return cls(config.get('connectBot'))
+
+    def get(self, section, key, default=None):
+        return (self.settings.get(section) or dict()).get(key, default)
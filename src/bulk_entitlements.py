@@ -0,0 +1,175 @@
+import asyncio
+import csv
+import io
+import logging
+import re
+
+from symphony.bdk.core.service.message.message_service import MessageService
+from .client.connect_client import AsyncConnectApiClient
+from .entitlement_index import EntitlementIndex
+from .templates import TemplateRegistry
+from .tracing import detached
+from .user_resolver import UserResolver
+
+
+class BulkEntitlementAdder():
+    # Pipelines user resolution and add_entitlement calls for large lists of users
+
+    DEFAULT_CONCURRENCY = 10
+    # Jobs larger than this report live progress and run in the background
+    PROGRESS_THRESHOLD = 20
+    PROGRESS_INTERVAL = 2
+
+    def __init__(self, messages: MessageService, templates: TemplateRegistry, user_resolver: UserResolver,
+                 connect_client: AsyncConnectApiClient, entitlement_index: EntitlementIndex, concurrency=DEFAULT_CONCURRENCY):
+        self._messages = messages
+        self.templates = templates
+        self._user_resolver = user_resolver
+        self.connect_client = connect_client
+        self.entitlement_index = entitlement_index
+        self.concurrency = concurrency
+        self.jobs = set()
+
+    @staticmethod
+    def parse_identifiers(text):
+        # Symphony IDs and/or emails separated by commas, semicolons or whitespace
+        return list(dict.fromkeys(i for i in re.split(r'[\s,;]+', text) if i != ''))
+
+    @staticmethod
+    def parse_csv(content):
+        # Any cell holding a Symphony ID or an email is used, headers and other columns are ignored
+        identifiers = []
+        for row in csv.reader(io.StringIO(content)):
+            for cell in row:
+                cell = cell.strip()
+                if cell.isdigit() or '@' in cell:
+                    identifiers.append(cell)
+        return list(dict.fromkeys(identifiers))
+
+    async def add_users(self, stream_id, externalNetwork, identifiers):
+        if len(identifiers) > self.PROGRESS_THRESHOLD:
+            # Do not hold up the datafeed loop while a large job runs
+            task = asyncio.get_running_loop().create_task(detached(self.run(stream_id, externalNetwork, identifiers)))
+            self.jobs.add(task)
+            task.add_done_callback(self.jobs.discard)
+        else:
+            await self.run(stream_id, externalNetwork, identifiers)
+
+    async def run(self, stream_id, externalNetwork, identifiers):
+        progress = {
+            'total': len(identifiers),
+            'processed': 0,
+            'added': 0,
+            'failed': 0
+        }
+        user_dict = {i: UserResolver.invalid_user_profile(i) for i in identifiers}
+        result_dict = dict()
+        reporter = None
+        # Each update creates a new message version, later updates must target the latest one
+        progress_message = dict()
+
+        try:
+            if len(identifiers) > self.PROGRESS_THRESHOLD:
+                sent = await self._messages.send_message(stream_id, self.render_progress(externalNetwork, progress, False))
+                progress_message['message_id'] = sent.message_id
+                reporter = asyncio.get_running_loop().create_task(
+                    self.report_progress(stream_id, progress_message, externalNetwork, progress))
+
+            queue = asyncio.Queue(maxsize=self.concurrency * 2)
+            workers = [asyncio.get_running_loop().create_task(self.add_worker(queue, externalNetwork, user_dict, result_dict, progress))
+                       for _ in range(self.concurrency)]
+            try:
+                await self.resolve_users(queue, identifiers, user_dict, result_dict, progress)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+                await self._messages.update_message(stream_id, progress_message['message_id'],
+                                                    self.render_progress(externalNetwork, progress, True))
+        except Exception:
+            logging.exception(f'Bulk add of {len(identifiers)} users to {externalNetwork} failed')
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+            if 'message_id' in progress_message:
+                # Do not leave the progress message showing the job as still running
+                try:
+                    await self._messages.update_message(stream_id, progress_message['message_id'],
+                                                        self.render_progress(externalNetwork, progress, True, failed=True))
+                except Exception as err:
+                    logging.warning(f'Failed to update bulk add progress: {err}')
+            for identifier in identifiers:
+                result_dict.setdefault(identifier, "ERROR: Not processed")
+
+        # Render and send result
+        message = self.templates.render('entitlements_add_result.jinja2', externalNetwork=externalNetwork,
+                                        user_dict=user_dict, result_dict=result_dict, summary=progress)
+        await self._messages.send_message(stream_id, message)
+
+    async def resolve_users(self, queue, identifiers, user_dict, result_dict, progress):
+        # Resolves users one chunk at a time, feeding the add workers as soon as a chunk is known
+        chunk_size = self._user_resolver.chunk_size
+        for i in range(0, len(identifiers), chunk_size):
+            chunk = identifiers[i:i + chunk_size]
+            emails = [c for c in chunk if '@' in c]
+            symphonyIds = [c for c in chunk if c.isdigit()]
+            profiles = dict()
+            if emails:
+                profiles.update(await self._user_resolver.get_user_profiles_by_emails(emails))
+            if symphonyIds:
+                profiles.update(await self._user_resolver.get_user_profiles(symphonyIds))
+
+            for identifier in chunk:
+                profile = profiles.get(identifier.lower())
+                if profile is None:
+                    result_dict[identifier] = "ERROR: Invalid User"
+                    progress['processed'] += 1
+                    progress['failed'] += 1
+                    continue
+
+                user_dict[identifier] = profile
+                await queue.put((identifier, profile.id))
+
+    async def add_worker(self, queue, externalNetwork, user_dict, result_dict, progress):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            identifier, symphonyId = item
+            try:
+                status, result = await self.connect_client.add_entitlement(externalNetwork, symphonyId)
+            except Exception as err:
+                status, result = 'ERROR', f'ERROR: {err}'
+
+            if status == 'OK':
+                self.entitlement_index.add(externalNetwork, symphonyId, result)
+                result_dict[identifier] = 'User successfully added'
+                progress['added'] += 1
+            else:
+                result_dict[identifier] = result
+                progress['failed'] += 1
+            progress['processed'] += 1
+
+    async def report_progress(self, stream_id, progress_message, externalNetwork, progress):
+        reported = dict(progress)
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            if progress != reported:
+                reported = dict(progress)
+                try:
+                    updated = await self._messages.update_message(stream_id, progress_message['message_id'],
+                                                                  self.render_progress(externalNetwork, reported, False))
+                    progress_message['message_id'] = updated.message_id
+                except Exception as err:
+                    logging.warning(f'Failed to update bulk add progress: {err}')
+
+    def render_progress(self, externalNetwork, progress, completed, failed=False):
+        return self.templates.render('entitlements_bulk_progress.jinja2', externalNetwork=externalNetwork,
+                                     progress=progress, completed=completed, failed=failed)
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import math
+
+from symphony.bdk.core.service.message.message_service import MessageService
+
+
+class ChunkedMessageSender():
+    # Splits a large table over several messages so that none exceeds the pod's message size limit
+
+    # messageML characters per message, comfortably below the pod limit
+    DEFAULT_MAX_SIZE = 60000
+    # Size of a message holding no rows, i.e. headers, buttons and hidden fields
+    DEFAULT_BASE_SIZE = 4000
+
+    def __init__(self, messages: MessageService, max_size=DEFAULT_MAX_SIZE):
+        self._messages = messages
+        self.max_size = max_size
+
+    def rows_per_part(self, row_size, base_size=DEFAULT_BASE_SIZE):
+        return max(1, (self.max_size - base_size) // max(1, row_size))
+
+    async def send(self, stream_id, rows, render, row_size, base_size=DEFAULT_BASE_SIZE):
+        # render(rows, part, parts) returns the messageML of one part. Parts are sent in order,
+        # each one rendered while the previous one is being posted. Returns the number of parts.
+        per_part = self.rows_per_part(row_size, base_size)
+        remaining = list(rows)
+        part = 0
+        sending = None
+
+        try:
+            while True:
+                parts = part + max(1, math.ceil(len(remaining) / per_part))
+                chunk = remaining[:per_part]
+                message = render(chunk, part + 1, parts)
+                if len(message) > self.max_size and len(chunk) > 1:
+                    # Rows are larger than estimated, resize from the actual size of this part
+                    per_part = max(1, min(len(chunk) - 1, int(len(chunk) * self.max_size / len(message) * 0.9)))
+                    logging.debug('Message part of %d rows is %d characters, retrying with %d rows', len(chunk), len(message), per_part)
+                    continue
+
+                remaining = remaining[len(chunk):]
+                part += 1
+                if sending is not None:
+                    await sending
+                sending = asyncio.ensure_future(self._messages.send_message(stream_id, message))
+                if not remaining:
+                    break
+                # Let the send go out before rendering the next part
+                await asyncio.sleep(0)
+
+            await sending
+            sending = None
+        finally:
+            if sending is not None:
+                sending.cancel()
+
+        return part
@@ -1,58 +1,103 @@
-import requests
+import aiohttp
+import asyncio
 import json
-import datetime
+import ssl
 import logging
-import urllib.parse
-from jose import jwt
-from json.decoder import JSONDecodeError
-
-
-class ConnectApiClient():
-
-    def __init__(self, config):
+import time
+from ..metrics import MetricsRegistry
+from ..tracing import annotate, span
+from .rate_limiter import TokenBucket, parse_retry_after
+from .resilience import CircuitBreaker, RetryPolicy
+from .models import Entitlement
+from .single_flight import SingleFlight
+from .token_manager import ConnectTokenManager
+
+
+try:
+    # Optional faster JSON decoder, used when installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Templated path of the advisor permission endpoints, used as the metrics label
+ADVISOR_PERMISSIONS_ENDPOINT = '/api/v1/customer/advisors/advisorEmailAddress/{advisorEmail}/externalNetwork/{externalNetwork}/permissions'
+
+
+class ConnectApiError(Exception):
+    # Raised by the streaming APIs, which cannot return an error status
+    pass
+
+
+class AsyncConnectApiClient():
+
+    # Defaults for the optional connectionPool section of each context entry
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_KEEP_ALIVE = 30
+    DEFAULT_CONNECT_TIMEOUT = 5
+    DEFAULT_READ_TIMEOUT = 30
+    DEFAULT_REQUEST_TIMEOUT = 60
+    # Requests rejected with 429 are retried this many times after waiting out Retry-After
+    MAX_THROTTLE_RETRIES = 5
+    DEFAULT_RETRY_AFTER = 1
+    # Default for the optional maxConcurrency setting of each context entry
+    DEFAULT_MAX_CONCURRENCY = 10
+
+    def __init__(self, config, metrics: MetricsRegistry = None):
         self.config = config
-        self.jwt = None
-
-
-    def list_permission(self, externalNetwork):
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.token_manager = ConnectTokenManager(config)
+        self.sessions = dict()
+        self.semaphores = dict()
+        self.retry_policies = dict()
+        self.circuit_breakers = dict()
+        self.rate_limiters = dict()
+        self.single_flight = SingleFlight()
+        self.ssl_context = None
+
+
+    async def list_permission(self, externalNetwork):
         url = f'/api/v1/customer/permissions'
-        status, result = self.execute_rest_call(externalNetwork, "GET", url)
+        status, result = await self.execute_rest_call(externalNetwork, "GET", url, '/api/v1/customer/permissions')
 
         return status, result
 
 
-    def get_advisor_permission(self, externalNetwork, advisorEmail):
+    async def get_advisor_permission(self, externalNetwork, advisorEmail):
         url = f'/api/v1/customer/advisors/advisorEmailAddress/{advisorEmail}/externalNetwork/{externalNetwork}/permissions'
-        status, result = self.execute_rest_call(externalNetwork, "GET", url)
+        status, result = await self.execute_rest_call(externalNetwork, "GET", url, ADVISOR_PERMISSIONS_ENDPOINT)
 
         return status, result
 
 
-    def add_permission(self, externalNetwork, advisorEmail, permissionName):
+    async def add_permission(self, externalNetwork, advisorEmail, permissionName):
         url = f'/api/v1/customer/advisors/advisorEmailAddress/{advisorEmail}/externalNetwork/{externalNetwork}/permissions'
         body = {
             "permissionName": permissionName
             }
 
-        status, result = self.execute_rest_call(externalNetwork, "POST", url, json=body)
+        status, result = await self.execute_rest_call(externalNetwork, "POST", url, ADVISOR_PERMISSIONS_ENDPOINT, json=body)
 
         return status, result
 
 
-    def delete_permission(self, externalNetwork, advisorEmail, permissionName):
+    async def delete_permission(self, externalNetwork, advisorEmail, permissionName):
         url = f'/api/v1/customer/advisors/advisorEmailAddress/{advisorEmail}/externalNetwork/{externalNetwork}/permissions/{permissionName}'
-        status, result = self.execute_rest_call(externalNetwork, "DELETE", url)
+        status, result = await self.execute_rest_call(externalNetwork, "DELETE", url, ADVISOR_PERMISSIONS_ENDPOINT + '/{permissionName}')
 
         return status, result
 
 
-    def list_entitlements(self, externalNetwork, page_cursor=''):
+    async def list_entitlements(self, externalNetwork, page_cursor=''):
         base_url = f'/api/v1/customer/entitlements/externalNetwork/{externalNetwork}/advisors'
         next_url = base_url + page_cursor
-        status, result = self.execute_rest_call(externalNetwork, "GET", next_url)
+        status, result = await self.execute_rest_call(externalNetwork, "GET", next_url, '/api/v1/customer/entitlements/externalNetwork/{externalNetwork}/advisors')
         next_cursor = ''
         prev_cursor = ''
 
+        if status == 'OK' and 'entitlements' in result:
+            # Copied rather than changed in place, the result may be shared with coalesced callers
+            result = dict(result, entitlements=[Entitlement.from_json(e) for e in result['entitlements']])
         if status == 'OK' and 'pagination' in result:
             if 'next' in result['pagination'] and result['pagination']['next'] is not None:
                 next_cursor = result['pagination']['next']
@@ -62,31 +107,55 @@ class ConnectApiClient():
         return status, result, next_cursor, prev_cursor
 
 
-    def delete_entitlement(self, externalNetwork, symphonyId):
+    async def iter_entitlements(self, externalNetwork):
+        # Streams entitlements across all pages, holding one page in memory at a time
+        page_cursor = ''
+        seen_cursors = set()
+        while True:
+            status, result, next_cursor, _ = await self.list_entitlements(externalNetwork, page_cursor)
+            if status != 'OK':
+                raise ConnectApiError(result)
+
+            for entitlement in result.get('entitlements', []):
+                yield entitlement
+
+            if next_cursor == '' or next_cursor in seen_cursors:
+                return
+            seen_cursors.add(next_cursor)
+            page_cursor = next_cursor
+
+
+    async def delete_entitlement(self, externalNetwork, symphonyId):
         url = f'/api/v1/customer/entitlements/{symphonyId}/entitlementType/{externalNetwork}'
-        status, result = self.execute_rest_call(externalNetwork, "DELETE", url)
+        status, result = await self.execute_rest_call(externalNetwork, "DELETE", url, '/api/v1/customer/entitlements/{symphonyId}/entitlementType/{externalNetwork}')
 
         return status, result
 
 
-    def add_entitlement(self, externalNetwork, symphonyId):
+    async def add_entitlement(self, externalNetwork, symphonyId):
         url = f'/api/v2/customer/entitlements'
         body = {
             "externalNetwork": externalNetwork,
             "symphonyId": symphonyId
             }
 
-        status, result = self.execute_rest_call(externalNetwork, "POST", url, json=body)
+        status, result = await self.execute_rest_call(externalNetwork, "POST", url, '/api/v2/customer/entitlements', json=body)
 
-        return status, result
+        return status, self.parse_entitlement(status, result)
 
 
-    def get_entitlement(self, externalNetwork, symphonyId):
+    async def get_entitlement(self, externalNetwork, symphonyId):
         url = f'/api/v2/customer/advisor/entitlements?externalNetwork={externalNetwork}&advisorSymphonyId={symphonyId}'
 
-        status, result = self.execute_rest_call(externalNetwork, "GET", url)
+        status, result = await self.execute_rest_call(externalNetwork, "GET", url, '/api/v2/customer/advisor/entitlements')
 
-        return status, result
+        return status, self.parse_entitlement(status, result)
+
+
+    def parse_entitlement(self, status, result):
+        if status == 'OK' and isinstance(result, dict) and 'symphonyId' in result:
+            return Entitlement.from_json(result)
+        return result
 
 
     def parse_result(self, apiResult, responseCode):
@@ -114,80 +183,267 @@ class ConnectApiClient():
             return 'ERROR: No response found from API call'
 
 
-    def get_session(self, externalNetwork):
-        session = requests.Session()
-
-        if self.jwt is not None:
-            jwt = self.jwt
-        else:
-            jwt = self.create_jwt(externalNetwork)
-
-        session.headers.update({
-            'Content-Type': "application/json",
-            'Authorization': "Bearer " + jwt}
-        )
-
+    def get_ssl_context(self):
         ## TODO: Implement Proxy support
-        # session.proxies.update(self.config.data['proxyRequestObject'])
-        if self.config.ssl:
+        if self.ssl_context is None and self.config.ssl:
             logging.debug("Setting truststorePath to {}".format(
                 self.config.ssl.trust_store_path)
             )
-            session.verify = self.config.ssl.trust_store_path
+            self.ssl_context = ssl.create_default_context(cafile=self.config.ssl.trust_store_path)
+
+        return self.ssl_context
 
+
+    def get_session(self, externalNetwork):
+        # One long-lived pooled session per external network, created on first use
+        session = self.sessions.get(externalNetwork)
+        if session is not None and not session.closed:
+            return session
+
+        pool_config = self.config.context.get(externalNetwork).get("connectionPool") or {}
+        connector = aiohttp.TCPConnector(
+            limit=pool_config.get("size", self.DEFAULT_POOL_SIZE),
+            keepalive_timeout=pool_config.get("keepAlive", self.DEFAULT_KEEP_ALIVE),
+            ssl=self.get_ssl_context() or True
+        )
+        # One timeout for every request of the session, aiohttp replaces rather than merges a per-request one
+        timeout = aiohttp.ClientTimeout(
+            total=pool_config.get("requestTimeout", self.DEFAULT_REQUEST_TIMEOUT),
+            sock_connect=pool_config.get("connectTimeout", self.DEFAULT_CONNECT_TIMEOUT),
+            sock_read=pool_config.get("readTimeout", self.DEFAULT_READ_TIMEOUT)
+        )
+        headers = {
+            'Content-Type': "application/json"
+        }
+        # aiohttp asks for gzip and deflate by default, it has to be told to leave the header out
+        skip_auto_headers = () if pool_config.get("gzip", True) else ('Accept-Encoding',)
+
+        session = aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout, skip_auto_headers=skip_auto_headers)
+        self.sessions[externalNetwork] = session
         return session
 
 
-    def execute_rest_call(self, externalNetwork, method, path, **kwargs):
+    def get_semaphore(self, externalNetwork):
+        # Bounds the number of in-flight requests per external network
+        if externalNetwork not in self.semaphores:
+            max_concurrency = self.config.context.get(externalNetwork).get("maxConcurrency", self.DEFAULT_MAX_CONCURRENCY)
+            self.semaphores[externalNetwork] = asyncio.Semaphore(max_concurrency)
+
+        return self.semaphores[externalNetwork]
+
+
+    async def close(self):
+        await self.token_manager.stop()
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+    def get_retry_policy(self, externalNetwork):
+        if externalNetwork not in self.retry_policies:
+            retry_config = self.config.context.get(externalNetwork).get("retry") or {}
+            self.retry_policies[externalNetwork] = RetryPolicy(
+                retry_config.get("maxAttempts", RetryPolicy.DEFAULT_MAX_ATTEMPTS),
+                retry_config.get("baseDelay", RetryPolicy.DEFAULT_BASE_DELAY),
+                retry_config.get("maxDelay", RetryPolicy.DEFAULT_MAX_DELAY)
+            )
+
+        return self.retry_policies[externalNetwork]
+
+
+    def get_circuit_breaker(self, externalNetwork):
+        if externalNetwork not in self.circuit_breakers:
+            breaker_config = self.config.context.get(externalNetwork).get("circuitBreaker") or {}
+            self.circuit_breakers[externalNetwork] = CircuitBreaker(
+                breaker_config.get("failureThreshold", CircuitBreaker.DEFAULT_FAILURE_THRESHOLD),
+                breaker_config.get("resetTimeout", CircuitBreaker.DEFAULT_RESET_TIMEOUT)
+            )
+
+        return self.circuit_breakers[externalNetwork]
+
+
+    def get_rate_limiter(self, externalNetwork):
+        if externalNetwork not in self.rate_limiters:
+            limit_config = self.config.context.get(externalNetwork).get("rateLimit") or {}
+            self.rate_limiters[externalNetwork] = TokenBucket(
+                limit_config.get("rate", TokenBucket.DEFAULT_RATE),
+                limit_config.get("burst", TokenBucket.DEFAULT_BURST),
+                limit_config.get("minRate", TokenBucket.DEFAULT_MIN_RATE)
+            )
+
+        return self.rate_limiters[externalNetwork]
+
+
+    async def send_request(self, externalNetwork, method, url, endpoint, jwt, **kwargs):
+        session = self.get_session(externalNetwork)
+        headers = {'Authorization': "Bearer " + jwt}
+
+        await self.get_rate_limiter(externalNetwork).acquire()
+        async with self.get_semaphore(externalNetwork):
+            # Timed once a slot is free, so the histogram shows Connect latency rather than local queueing
+            start = time.perf_counter()
+            status = 'ERROR'
+            try:
+                async with session.request(method, url, headers=headers, **kwargs) as response:
+                    status = str(response.status)
+                    # Raw bytes, decoded straight to objects without an intermediate str copy
+                    return response.status, await response.read(), response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                status = type(err).__name__
+                raise
+            finally:
+                self.metrics.observe_call('connect', externalNetwork, endpoint, method, status, time.perf_counter() - start)
+
+
+    async def execute_rest_call(self, externalNetwork, method, path, endpoint, **kwargs):
+        # endpoint is the templated path, used for metrics so emails and IDs stay out of label values
+        with span('connect', network=externalNetwork, method=method, endpoint=endpoint):
+            # Identical concurrent GETs share one upstream call and its (read-only) result
+            if method == "GET" and not kwargs:
+                status, result = await self.single_flight.do((externalNetwork, method, path),
+                                                             lambda: self.invoke_rest_call(externalNetwork, method, path, endpoint))
+            else:
+                status, result = await self.invoke_rest_call(externalNetwork, method, path, endpoint, **kwargs)
+            annotate(status=status)
+            return status, result
+
+
+    def get_coalesced_calls(self):
+        # Number of upstream calls saved by sharing in-flight GETs
+        return self.single_flight.shared
+
+
+    async def invoke_rest_call(self, externalNetwork, method, path, endpoint, **kwargs):
         results = None
         apiURL = self.config.context.get(externalNetwork).get("apiURL")
 
         url = apiURL + path
-        session = self.get_session(externalNetwork)
-        try:
-            logging.debug(f'Invoke API URL: {url}')
-            response = session.request(method, url, **kwargs)
-        except requests.exceptions.ConnectionError as err:
-            logging.error(err)
-            logging.error(type(err))
-            raise
-
-        if response.status_code == 204:
+        retry_policy = self.get_retry_policy(externalNetwork)
+        circuit_breaker = self.get_circuit_breaker(externalNetwork)
+        rate_limiter = self.get_rate_limiter(externalNetwork)
+        attempt = 0
+        throttle_retries = 0
+        reauthenticated = False
+
+        while True:
+            # Fail fast while Connect is down instead of piling up blocked handlers
+            if not circuit_breaker.allow_request():
+                logging.warning('Circuit open for %s, skipping %s %s', externalNetwork, method, endpoint)
+                self.metrics.inc('circuit_rejections_total', network=externalNetwork, endpoint=endpoint)
+                return 'ERROR', f'ERROR: {externalNetwork} Connect API is unavailable, please try again later'
+
+            attempt += 1
+            jwt = await self.token_manager.get_token(externalNetwork)
+            try:
+                # Templated endpoint rather than the URL, which holds advisor emails
+                logging.debug('Invoke API %s %s %s', externalNetwork, method, endpoint)
+                status_code, response_body, retry_after = await self.send_request(externalNetwork, method, url, endpoint, jwt, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                circuit_breaker.record_failure()
+                if retry_policy.should_retry(method, attempt):
+                    logging.warning('%s %s failed with %s, retrying (attempt %d)', method, endpoint, type(err).__name__, attempt)
+                    self.metrics.inc('retries_total', network=externalNetwork, endpoint=endpoint, reason='error')
+                    await asyncio.sleep(retry_policy.backoff(attempt))
+                    continue
+                logging.error('%s %s failed after %d attempts: %s %s', method, endpoint, attempt, type(err).__name__, err)
+                return 'ERROR', f'ERROR: Connect API call failed - {type(err).__name__}'
+
+            if status_code >= 500:
+                circuit_breaker.record_failure()
+                if retry_policy.should_retry(method, attempt):
+                    logging.warning('%s %s returned %d, retrying (attempt %d)', method, endpoint, status_code, attempt)
+                    self.metrics.inc('retries_total', network=externalNetwork, endpoint=endpoint, reason='server_error')
+                    await asyncio.sleep(retry_policy.backoff(attempt))
+                    continue
+            else:
+                circuit_breaker.record_success()
+
+            # Throttled - slow down this network and wait as long as the server asks
+            if status_code == 429:
+                wait = parse_retry_after(retry_after, self.DEFAULT_RETRY_AFTER)
+                rate_limiter.throttled(wait)
+                if throttle_retries < self.MAX_THROTTLE_RETRIES:
+                    logging.info('%s %s throttled, retrying in %.1fs at %.1f req/s', method, endpoint, wait, rate_limiter.rate)
+                    self.metrics.inc('retries_total', network=externalNetwork, endpoint=endpoint, reason='throttled')
+                    throttle_retries += 1
+                    attempt -= 1
+                    continue
+            elif status_code < 500:
+                rate_limiter.succeeded()
+
+            # JWT Expired - Generate new one, once
+            if status_code == 401 and not reauthenticated:
+                logging.info("JWT Expired - Reauthenticating...")
+                self.token_manager.invalidate(externalNetwork, jwt)
+                reauthenticated = True
+                self.metrics.inc('retries_total', network=externalNetwork, endpoint=endpoint, reason='reauthenticate')
+                attempt -= 1
+                continue
+            break
+
+        if status_code == 204:
             results = []
-        # JWT Expired - Generate new one
-        elif response.status_code == 401:
-            logging.info("JWT Expired - Reauthenticating...")
-            self.jwt = None
-            return self.execute_rest_call(externalNetwork, method, path, **kwargs)
         else:
             try:
-                results = json.loads(response.text)
-            except JSONDecodeError:
-                results = response.text
+                results = json_loads(response_body)
+            except ValueError:
+                results = response_body.decode('utf-8', 'replace')
 
-        final_output = self.parse_result(results, response.status_code)
+        final_output = self.parse_result(results, status_code)
         # logging.debug(results)
         # logging.debug(f'API Output: {final_output}')
-        if response.status_code in (200, 201, 204):
+        if status_code in (200, 201, 204):
             return 'OK', results
         else:
             return 'ERROR', final_output
 
 
-    def create_jwt(self, externalNetwork):
-        with open(self.config.context.get(externalNetwork).get("privateKey").get("path"), 'r') as f:
-            content = f.readlines()
-            private_key = ''.join(content)
-            current_date = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-            expiration_date = current_date + (5*58)
+class ConnectApiClient():
+    # Blocking wrapper around AsyncConnectApiClient for use from scripts.
+    # Must not be used from inside a running event loop (e.g. bot activities).
+
+    def __init__(self, config):
+        self.config = config
+        self._client = AsyncConnectApiClient(config)
+        self._loop = asyncio.new_event_loop()
+
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+
+    def list_permission(self, externalNetwork):
+        return self._run(self._client.list_permission(externalNetwork))
+
+
+    def get_advisor_permission(self, externalNetwork, advisorEmail):
+        return self._run(self._client.get_advisor_permission(externalNetwork, advisorEmail))
+
+
+    def add_permission(self, externalNetwork, advisorEmail, permissionName):
+        return self._run(self._client.add_permission(externalNetwork, advisorEmail, permissionName))
+
+
+    def delete_permission(self, externalNetwork, advisorEmail, permissionName):
+        return self._run(self._client.delete_permission(externalNetwork, advisorEmail, permissionName))
+
+
+    def list_entitlements(self, externalNetwork, page_cursor=''):
+        return self._run(self._client.list_entitlements(externalNetwork, page_cursor))
+
+
+    def delete_entitlement(self, externalNetwork, symphonyId):
+        return self._run(self._client.delete_entitlement(externalNetwork, symphonyId))
+
+
+    def add_entitlement(self, externalNetwork, symphonyId):
+        return self._run(self._client.add_entitlement(externalNetwork, symphonyId))
+
+
+    def get_entitlement(self, externalNetwork, symphonyId):
+        return self._run(self._client.get_entitlement(externalNetwork, symphonyId))
 
-            payload = {
-                'sub': 'ces:customer:' + self.config.context.get(externalNetwork).get("publicKeyId"),
-                'exp': expiration_date,
-                'iat': current_date
-            }
 
-            encoded = jwt.encode(payload, private_key, algorithm='RS512')
-            f.close()
-            self.jwt = encoded
-            return encoded
+    def close(self):
+        self._run(self._client.close())
+        self._loop.close()
@@ -0,0 +1,62 @@
+import sys
+
+
+def permission_names(result):
+    # Connect returns either permission names or permission objects, names are interned
+    # as the same few permissions repeat across every advisor
+    output = []
+    if isinstance(result, dict) and 'permissions' in result:
+        for p in result['permissions']:
+            if isinstance(p, dict) and 'permissionName' in p:
+                p = p['permissionName']
+            output.append(sys.intern(p) if isinstance(p, str) else p)
+    return output
+
+
+class Entitlement():
+    # One advisor entitled to an external network. Templates read fields as entitlement['symphonyId']
+
+    __slots__ = ('symphonyId', 'externalNetwork')
+
+    def __init__(self, symphonyId, externalNetwork):
+        self.symphonyId = str(symphonyId)
+        self.externalNetwork = sys.intern(externalNetwork) if isinstance(externalNetwork, str) else externalNetwork
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get('symphonyId'), data.get('externalNetwork'))
+
+    def __getitem__(self, key):
+        # Lets Jinja subscripts hit the field directly rather than falling back to getattr on a TypeError
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'Entitlement({self.symphonyId}, {self.externalNetwork})'
+
+
+class AdvisorProfile():
+    # The fields of a Symphony user profile the bot uses, instead of the full pod user record
+
+    __slots__ = ('id', 'display_name', 'email_address')
+
+    def __init__(self, id, display_name, email_address):
+        self.id = id
+        self.display_name = display_name
+        self.email_address = email_address
+
+    @classmethod
+    def from_user(cls, user):
+        # user is a pod user record (or dict) as returned by UserService, the pod leaves out empty fields
+        return cls(user['id'], user.get('display_name') or '', user.get('email_address') or '')
+
+    @classmethod
+    def invalid(cls, symphonyId):
+        # Placeholder rendered for ids or emails that are not valid Symphony users
+        return cls(None, symphonyId, '')
+
+    def __getitem__(self, key):
+        # Templates read profile['display_name'], see Entitlement
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'AdvisorProfile({self.id}, {self.display_name})'
@@ -0,0 +1,72 @@
+import asyncio
+import datetime
+import time
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value, default):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket():
+    # Smooths bursts to a sustainable request rate, halving it when the server throttles
+    # and creeping back up to the configured rate as requests succeed
+
+    DEFAULT_RATE = 20
+    DEFAULT_BURST = 20
+    DEFAULT_MIN_RATE = 1
+    # Fraction of the configured rate recovered per successful request
+    RECOVERY_STEP = 0.01
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=DEFAULT_MIN_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.throttled_count = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return now
+
+    async def acquire(self):
+        # Waiters are served in arrival order
+        async with self.lock:
+            while True:
+                now = self.refill()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self, retry_after):
+        self.refill()
+        self.throttled_count += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.RECOVERY_STEP)
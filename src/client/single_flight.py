@@ -0,0 +1,25 @@
+import asyncio
+
+
+class SingleFlight():
+    # Shares one in-flight call between all concurrent callers using the same key
+
+    def __init__(self):
+        self.calls = dict()
+        self.shared = 0
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self.forget(key, t))
+
+        # A cancelled caller must not cancel the call other callers are waiting on
+        return await asyncio.shield(task)
+
+    def forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
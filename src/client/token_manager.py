@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+
+class ConnectTokenManager():
+    # Caches the Connect private keys and one JWT per external network,
+    # re-signing tokens in the background before they expire.
+
+    TOKEN_LIFETIME = 5*58
+    # Tokens are re-signed this many seconds before they expire
+    REFRESH_MARGIN = 60
+    # A cached token is never handed out with less than this left
+    MIN_VALIDITY = 10
+
+    def __init__(self, config):
+        self.config = config
+        self.private_keys = dict()
+        self.tokens = dict()
+        self.locks = dict()
+        self.refresh_task = None
+
+
+    async def get_token(self, externalNetwork):
+        token = self.tokens.get(externalNetwork)
+        if token is not None and token[1] - time.time() > self.MIN_VALIDITY:
+            return token[0]
+
+        lock = self.locks.setdefault(externalNetwork, asyncio.Lock())
+        async with lock:
+            # Another caller may have refreshed the token while we waited
+            token = self.tokens.get(externalNetwork)
+            if token is not None and token[1] - time.time() > self.MIN_VALIDITY:
+                return token[0]
+            return await self.refresh_token(externalNetwork)
+
+
+    async def refresh_token(self, externalNetwork):
+        loop = asyncio.get_running_loop()
+        # Key loading and RS512 signing are blocking, keep them off the event loop
+        encoded, expiration_date = await loop.run_in_executor(None, self.create_jwt, externalNetwork)
+        self.tokens[externalNetwork] = (encoded, expiration_date)
+        self.start()
+        return encoded
+
+
+    def invalidate(self, externalNetwork, rejected_token):
+        # Only drop the token if it is the one the server rejected
+        token = self.tokens.get(externalNetwork)
+        if token is not None and token[0] == rejected_token:
+            del self.tokens[externalNetwork]
+
+
+    def load_private_key(self, externalNetwork):
+        path = self.config.context.get(externalNetwork).get("privateKey").get("path")
+        if path not in self.private_keys:
+            with open(path, 'r') as f:
+                self.private_keys[path] = f.read()
+
+        return self.private_keys[path]
+
+
+    def create_jwt(self, externalNetwork):
+        # jose pulls in the crypto backends, imported on first signing rather than at startup
+        from jose import jwt
+
+        private_key = self.load_private_key(externalNetwork)
+        current_date = int(time.time())
+        expiration_date = current_date + self.TOKEN_LIFETIME
+
+        payload = {
+            'sub': 'ces:customer:' + self.config.context.get(externalNetwork).get("publicKeyId"),
+            'exp': expiration_date,
+            'iat': current_date
+        }
+
+        encoded = jwt.encode(payload, private_key, algorithm='RS512')
+        return encoded, expiration_date
+
+
+    def start(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.get_running_loop().create_task(self.refresh_loop())
+
+
+    async def refresh_loop(self):
+        failures = 0
+        while True:
+            # Tokens that expired are dropped, get_token signs a new one on demand and restarts the loop
+            now = time.time()
+            for externalNetwork in [n for n, (_, exp) in self.tokens.items() if exp <= now]:
+                del self.tokens[externalNetwork]
+            if not self.tokens:
+                return
+
+            next_refresh = min(exp for _, exp in self.tokens.values()) - self.REFRESH_MARGIN
+            delay = max(next_refresh - now, 1)
+            if failures:
+                # Back off while signing keeps failing, e.g. on a bad key path
+                delay = max(delay, min(2 ** failures, self.REFRESH_MARGIN))
+            await asyncio.sleep(delay)
+
+            failed = False
+            for externalNetwork, (_, exp) in list(self.tokens.items()):
+                if exp - time.time() <= self.REFRESH_MARGIN:
+                    try:
+                        async with self.locks.setdefault(externalNetwork, asyncio.Lock()):
+                            await self.refresh_token(externalNetwork)
+                        logging.debug("Refreshed Connect JWT for %s", externalNetwork)
+                    except Exception as err:
+                        # Leave the old token in place until it expires, get_token will retry on demand
+                        failed = True
+                        if failures == 0:
+                            logging.exception("Failed to refresh Connect JWT for %s", externalNetwork)
+                        else:
+                            logging.warning("Failed to refresh Connect JWT for %s: %s", externalNetwork, err)
+            failures = failures + 1 if failed else 0
+
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
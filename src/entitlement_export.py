@@ -0,0 +1,128 @@
+import asyncio
+import csv
+import datetime
+import io
+import logging
+import os
+import tempfile
+
+from symphony.bdk.core.service.message.message_service import MessageService
+from .client.connect_client import AsyncConnectApiClient
+from .client.models import permission_names
+from .tracing import detached
+from .user_resolver import UserResolver
+
+
+def csv_safe(value):
+    # Stops names such as "=HYPERLINK(...)" being run as formulas when the report is opened in a spreadsheet
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        return "'" + value
+    return value
+
+
+class EntitlementExporter():
+    # Streams every entitlement of a network with its user profile and permissions into a CSV attachment.
+    # Memory is bounded by the batch size, the CSV is written to a temporary file.
+
+    BATCH_SIZE = 100
+    # Batches crawled ahead of the one being enriched
+    QUEUE_SIZE = 2
+    HEADER = ['Symphony ID', 'Name', 'Email', 'External Network', 'Permissions', 'Status']
+
+    def __init__(self, messages: MessageService, user_resolver: UserResolver, connect_client: AsyncConnectApiClient):
+        self._messages = messages
+        self._user_resolver = user_resolver
+        self.connect_client = connect_client
+        self.jobs = set()
+
+    def start(self, stream_id, externalNetwork):
+        # Large networks take minutes, do not hold up the datafeed loop
+        task = asyncio.get_running_loop().create_task(detached(self.export(stream_id, externalNetwork)))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+
+    async def export(self, stream_id, externalNetwork):
+        rows = 0
+        name = f'{externalNetwork}_entitlements_{datetime.date.today().isoformat()}.csv'
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                # A real file named as the attachment, the message API reads and closes it
+                with open(os.path.join(directory, name), 'w+b') as file:
+                    # Rows are formatted through a small text buffer and written as UTF-8 bytes
+                    line = io.StringIO()
+                    writer = csv.writer(line)
+                    writer.writerow(self.HEADER)
+                    async for row in self.iter_rows(externalNetwork):
+                        writer.writerow(row)
+                        rows += 1
+                        if line.tell() > 64 * 1024:
+                            file.write(line.getvalue().encode('utf-8'))
+                            line.seek(0)
+                            line.truncate()
+                    file.write(line.getvalue().encode('utf-8'))
+
+                    file.seek(0)
+                    await self._messages.send_message(stream_id, f"<messageML>Exported {rows} {externalNetwork} entitlements</messageML>",
+                                                      attachment=file)
+        except Exception:
+            logging.exception('Export of %s entitlements failed', externalNetwork)
+            await self._messages.send_message(stream_id, f"<messageML>Export of {externalNetwork} entitlements failed, please try again later</messageML>")
+
+    async def iter_rows(self, externalNetwork):
+        # Enriches one batch while the next is being crawled
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        crawler = asyncio.get_running_loop().create_task(self.crawl(externalNetwork, queue))
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for row in await self.enrich(externalNetwork, batch):
+                    yield row
+        finally:
+            crawler.cancel()
+
+    async def crawl(self, externalNetwork, queue):
+        try:
+            batch = []
+            async for entitlement in self.connect_client.iter_entitlements(externalNetwork):
+                batch.append(entitlement)
+                if len(batch) == self.BATCH_SIZE:
+                    await queue.put(batch)
+                    batch = []
+            if batch:
+                await queue.put(batch)
+            await queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            await queue.put(err)
+
+    async def enrich(self, externalNetwork, batch):
+        profiles = await self._user_resolver.get_user_profiles([e.symphonyId for e in batch])
+        # Read straight from Connect rather than through PermissionService, so a full export
+        # does not fill its advisor cache
+        permissions = await asyncio.gather(*[self.get_permissions(externalNetwork, profiles.get(e.symphonyId)) for e in batch],
+                                           return_exceptions=True)
+
+        rows = []
+        for entitlement, advisor_permissions in zip(batch, permissions):
+            profile = profiles.get(entitlement.symphonyId) or UserResolver.invalid_user_profile(entitlement.symphonyId)
+            if profile.email_address == '':
+                status = 'ERROR: Invalid user or user not found'
+            elif isinstance(advisor_permissions, Exception) or advisor_permissions is None:
+                status = 'ERROR: Permissions could not be retrieved'
+            else:
+                status = 'OK'
+            permission_list = advisor_permissions if isinstance(advisor_permissions, list) else []
+            rows.append([entitlement.symphonyId, csv_safe(profile.display_name), csv_safe(profile.email_address),
+                         entitlement.externalNetwork, ';'.join(permission_list), status])
+        return rows
+
+    async def get_permissions(self, externalNetwork, profile):
+        if profile is None or profile.email_address == '':
+            return None
+        status, result = await self.connect_client.get_advisor_permission(externalNetwork, profile.email_address)
+        return permission_names(result) if status == 'OK' else None
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+
+from .client.connect_client import AsyncConnectApiClient, ConnectApiError
+from .client.models import AdvisorProfile, Entitlement
+
+
+class EntitlementIndex():
+    # In-memory index of all Connect entitlements per external network, Entitlement records keyed by str(symphonyId).
+    # Answers the entitlement lookups and filtered listings of the search forms. Kept current incrementally:
+    # the bot's own adds and deletes are applied as they happen and every entitlement page the bot reads
+    # anyway is merged in. Connect only offers a paged listing of all entitlements, so removals made
+    # outside the bot are picked up by a periodic full crawl.
+
+    # Default for the optional entitlementIndexRefresh setting of each context entry, seconds between full crawls
+    DEFAULT_REFRESH_INTERVAL = 900
+    # Rows of a filtered listing, one message worth
+    MAX_FILTER_RESULTS = 100
+
+    def __init__(self, connect_client: AsyncConnectApiClient, config):
+        self.connect_client = connect_client
+        self.config = config
+        self.entitlements = dict()
+        self.loaded_at = dict()
+        # Changes made by the bot while a crawl is running, replayed onto its result
+        self.pending_changes = dict()
+        self.refresh_tasks = []
+
+    def is_ready(self, externalNetwork):
+        return externalNetwork in self.entitlements
+
+    def get(self, externalNetwork, symphonyId):
+        return self.entitlements.get(externalNetwork, dict()).get(str(symphonyId))
+
+    async def lookup(self, externalNetwork, symphonyId):
+        # Entitlement of one user, from the index once it is built and from Connect until then.
+        # None when the user is not entitled or Connect failed
+        if self.is_ready(externalNetwork):
+            return self.get(externalNetwork, symphonyId)
+
+        status, result = await self.connect_client.get_entitlement(externalNetwork, symphonyId)
+        return result if status == 'OK' else None
+
+    async def entitled_status(self, externalNetwork, user_profiles):
+        # Entitlement status of the users picked in a search form, user_profiles as returned by
+        # UserResolver.resolve_users. Returns ({symphonyId: Entitlement or "ERROR"}, {symphonyId: profile}),
+        # users not found on the pod get a placeholder profile
+        symphonyIds = [symphonyId for symphonyId, profile in user_profiles.items() if profile is not None]
+        entitlements = await asyncio.gather(*[self.lookup(externalNetwork, symphonyId) for symphonyId in symphonyIds])
+        found = dict(zip(symphonyIds, entitlements))
+
+        result_dict = dict()
+        profiles = dict()
+        for symphonyId, profile in user_profiles.items():
+            profiles[symphonyId] = profile if profile is not None else AdvisorProfile.invalid(symphonyId)
+            result_dict[symphonyId] = found.get(symphonyId) or "ERROR"
+        return result_dict, profiles
+
+    async def filter_entitlements(self, externalNetwork, text, user_resolver, limit=MAX_FILTER_RESULTS):
+        # Entitlements whose user's name, email or Symphony ID contains text, case-insensitive.
+        # Returns (entitlements sorted by name, {symphonyId: profile}, number of matches before the limit)
+        entitlements = list(self.entitlements.get(externalNetwork, dict()).values())
+        # Profiles come from the shared user cache, only users not seen recently are fetched from the pod
+        profiles = await user_resolver.get_user_profiles([e.symphonyId for e in entitlements])
+
+        text = text.strip().lower()
+        matches = []
+        for entitlement in entitlements:
+            profile = profiles.get(entitlement.symphonyId) or AdvisorProfile.invalid(entitlement.symphonyId)
+            if text in entitlement.symphonyId or text in profile.display_name.lower() or text in profile.email_address.lower():
+                matches.append((profile.display_name.lower(), entitlement, profile))
+
+        matches.sort(key=lambda m: m[0])
+        shown = matches[:limit]
+        return [m[1] for m in shown], {m[1].symphonyId: m[2] for m in shown}, len(matches)
+
+    def merge_page(self, externalNetwork, entitlements):
+        # Entitlement pages read for other purposes refresh the index for free
+        for entitlement in entitlements:
+            self.add(externalNetwork, entitlement.symphonyId, entitlement)
+
+    def add(self, externalNetwork, symphonyId, entitlement=None):
+        if not isinstance(entitlement, Entitlement):
+            entitlement = Entitlement(symphonyId, externalNetwork)
+        self.apply_change(externalNetwork, str(symphonyId), entitlement)
+
+    def remove(self, externalNetwork, symphonyId):
+        self.apply_change(externalNetwork, str(symphonyId), None)
+
+    def apply_change(self, externalNetwork, key, entitlement):
+        if externalNetwork in self.pending_changes:
+            self.pending_changes[externalNetwork][key] = entitlement
+
+        index = self.entitlements.get(externalNetwork)
+        if index is None:
+            return
+        if entitlement is None:
+            index.pop(key, None)
+        else:
+            index[key] = entitlement
+
+    async def build(self, externalNetwork):
+        start = time.monotonic()
+        index = dict()
+        self.pending_changes[externalNetwork] = dict()
+        try:
+            try:
+                async for entitlement in self.connect_client.iter_entitlements(externalNetwork):
+                    index[entitlement.symphonyId] = entitlement
+            except ConnectApiError as err:
+                logging.error(f'Failed to build entitlement index for {externalNetwork}: {err}')
+                return False
+
+            # Keep the bot's own changes made while the crawl was running
+            for key, entitlement in self.pending_changes[externalNetwork].items():
+                if entitlement is None:
+                    index.pop(key, None)
+                else:
+                    index[key] = entitlement
+
+            self.entitlements[externalNetwork] = index
+            self.loaded_at[externalNetwork] = time.time()
+            logging.info(f'Indexed {len(index)} entitlements for {externalNetwork} in {time.monotonic() - start:.2f}s')
+            return True
+        finally:
+            del self.pending_changes[externalNetwork]
+
+    def start(self):
+        for externalNetwork in self.config.context.keys():
+            self.refresh_tasks.append(asyncio.get_running_loop().create_task(self.refresh_loop(externalNetwork)))
+
+    async def refresh_loop(self, externalNetwork):
+        interval = self.config.context.get(externalNetwork).get("entitlementIndexRefresh", self.DEFAULT_REFRESH_INTERVAL)
+        while True:
+            try:
+                # Full crawl, the only way to see entitlements removed outside the bot
+                await self.build(externalNetwork)
+            except Exception:
+                # Keep serving the previous index, retry on the next cycle
+                logging.exception(f'Failed to refresh entitlement index for {externalNetwork}')
+            await asyncio.sleep(interval)
+
+    async def stop(self):
+        for task in self.refresh_tasks:
+            task.cancel()
+        await asyncio.gather(*self.refresh_tasks, return_exceptions=True)
+        self.refresh_tasks = []
@@ -0,0 +1,86 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from .tracing import TRACE_LOGGER
+
+
+class DebugRateLimitFilter(logging.Filter):
+    # Token bucket per call site for DEBUG records, other levels always pass.
+    # Dropped records are never formatted, the next one let through reports how many were suppressed.
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (pathname, lineno) -> [tokens, updated_at, suppressed]
+        self.buckets = dict()
+        # Records also arrive from executor threads
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get((record.pathname, record.lineno))
+            if bucket is None:
+                bucket = self.buckets[(record.pathname, record.lineno)] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+        return True
+
+
+class QueueLogging():
+    # Moves the handlers set up by logging.conf behind a queue, so console and file writes happen on a
+    # listener thread instead of blocking the event loop. The message is still formatted on the calling
+    # thread, so it shows the arguments as they were at the call, only DEBUG records dropped by the
+    # rate limit are never formatted
+
+    # Defaults for the optional connectBot logging section
+    DEFAULT_DEBUG_RATE = 20
+    DEFAULT_DEBUG_BURST = 100
+
+    def __init__(self, debug_rate=DEFAULT_DEBUG_RATE, debug_burst=DEFAULT_DEBUG_BURST, logger_names=('', TRACE_LOGGER)):
+        self.debug_rate = debug_rate
+        self.debug_burst = debug_burst
+        self.logger_names = logger_names
+        self.pipelines = []
+
+    def start(self):
+        for name in self.logger_names:
+            logger = logging.getLogger(name)
+            handlers = list(logger.handlers)
+            if not handlers:
+                continue
+
+            queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+            if self.debug_rate:
+                queue_handler.addFilter(DebugRateLimitFilter(self.debug_rate, self.debug_burst))
+            listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+            listener.start()
+            self.pipelines.append((logger, queue_handler, handlers, listener))
+
+    def stop(self):
+        # Flushes queued records and puts the original handlers back
+        for logger, queue_handler, handlers, listener in self.pipelines:
+            logger.removeHandler(queue_handler)
+            listener.stop()
+            for handler in handlers:
+                logger.addHandler(handler)
+        self.pipelines = []
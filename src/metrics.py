@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from .tracing import span
+
+# Reaches past the default 60s Connect request timeout, so timed out calls still land in a bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def format_quantile_ms(histogram, q):
+    # Upper bound of the quantile in milliseconds for /stats, or "> top bound" past the last bucket
+    bound = histogram.quantile(q)
+    if bound == float('inf'):
+        return f'> {round(histogram.buckets[-1] * 1000)}'
+    return f'<= {round(bound * 1000)}'
+
+
+class Histogram():
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry():
+    # Latency histograms and counters for calls to Connect and the Symphony pod,
+    # labelled by templated endpoint so that emails and IDs never become label values
+
+    PREFIX = 'connect_bot'
+
+    def __init__(self):
+        self.latencies = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.collectors = []
+
+    def observe_call(self, system, network, endpoint, method, status, seconds):
+        self.latencies[(system, network, endpoint, method)].observe(seconds)
+        self.inc('calls_total', system=system, network=network, endpoint=endpoint, method=method, status=status)
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def register_collector(self, collector):
+        # collector() returns {(name, labels tuple): value} read at scrape time, e.g. cache hit counts
+        self.collectors.append(collector)
+
+    def collect_counters(self):
+        values = dict(self.counters)
+        for collector in self.collectors:
+            try:
+                values.update(collector())
+            except Exception:
+                logging.exception('Metrics collector failed')
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        name = f'{self.PREFIX}_call_duration_seconds'
+        lines.append(f'# HELP {name} Latency of calls to Connect and the Symphony pod')
+        lines.append(f'# TYPE {name} histogram')
+        for (system, network, endpoint, method), histogram in sorted(self.latencies.items()):
+            labels = [('system', system), ('network', network), ('endpoint', endpoint), ('method', method)]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + [("le", "+Inf")])} {histogram.count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        by_name = defaultdict(list)
+        for (counter, labels), value in self.collect_counters().items():
+            by_name[counter].append((labels, value))
+        for counter, samples in sorted(by_name.items()):
+            lines.append(f'# TYPE {self.PREFIX}_{counter} counter')
+            for labels, value in sorted(samples):
+                lines.append(f'{self.PREFIX}_{counter}{format_labels(list(labels))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # Per endpoint figures for the /stats command
+        errors = defaultdict(int)
+        for (counter, labels), value in self.counters.items():
+            labels = dict(labels)
+            if counter == 'calls_total' and labels['status'] not in ('200', '201', '204', 'OK'):
+                errors[(labels['system'], labels['network'], labels['endpoint'], labels['method'])] += value
+
+        endpoints = []
+        for key, histogram in sorted(self.latencies.items()):
+            system, network, endpoint, method = key
+            endpoints.append({
+                'system': system,
+                'network': network,
+                'endpoint': endpoint,
+                'method': method,
+                'count': histogram.count,
+                'errors': errors[key],
+                'avg_ms': round(histogram.sum / histogram.count * 1000) if histogram.count else 0,
+                'p50_ms': format_quantile_ms(histogram, 0.5),
+                'p99_ms': format_quantile_ms(histogram, 0.99)
+            })
+
+        counters = [{'name': counter, 'labels': ', '.join(f'{k}={v}' for k, v in labels), 'value': value}
+                    for (counter, labels), value in sorted(self.collect_counters().items()) if counter != 'calls_total']
+        return endpoints, counters
+
+
+class InstrumentedService():
+    # Wraps a BDK service (e.g. UserService, MessageService) and times every coroutine it exposes
+
+    def __init__(self, service, system, metrics: MetricsRegistry):
+        self._service = service
+        self._system = system
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        endpoint = f'{type(self._service).__name__}.{name}'
+
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            status = 'OK'
+            try:
+                with span(self._system, call=endpoint):
+                    return await attr(*args, **kwargs)
+            except Exception as err:
+                status = type(err).__name__
+                raise
+            finally:
+                self._metrics.observe_call(self._system, '', endpoint, 'call', status, time.perf_counter() - start)
+
+        return timed
+
+
+class MetricsServer():
+    # Serves the registry in Prometheus text format on a local port
+
+    DEFAULT_HOST = '127.0.0.1'
+
+    def __init__(self, metrics: MetricsRegistry, port, host=DEFAULT_HOST):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=self.metrics.render_prometheus(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
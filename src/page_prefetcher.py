@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from .client.connect_client import AsyncConnectApiClient
+from .entitlement_index import EntitlementIndex
+from .tracing import detached
+from .user_resolver import UserResolver
+
+
+class EntitlementPagePrefetcher():
+    # Loads the next entitlement page and its user profiles while the admin reads the current one
+
+    # Prefetched pages are short lived as they do not see entitlement changes
+    DEFAULT_TTL = 30
+    MAX_PAGES = 50
+
+    def __init__(self, connect_client: AsyncConnectApiClient, user_resolver: UserResolver, entitlement_index: EntitlementIndex = None, ttl=DEFAULT_TTL):
+        self.connect_client = connect_client
+        self.user_resolver = user_resolver
+        self.entitlement_index = entitlement_index
+        self.ttl = ttl
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, externalNetwork, page_cursor, after=None):
+        # after is an optional coroutine function(userList, profiles) to warm other caches
+        key = (externalNetwork, page_cursor)
+        if page_cursor == '' or key in self.pages:
+            return
+
+        task = asyncio.get_running_loop().create_task(detached(self.load_page(externalNetwork, page_cursor, after)))
+        self.pages[key] = (task, time.monotonic() + self.ttl)
+        while len(self.pages) > self.MAX_PAGES:
+            _, (old_task, _) = self.pages.popitem(last=False)
+            old_task.cancel()
+
+    async def get_page(self, externalNetwork, page_cursor):
+        entry = self.pages.pop((externalNetwork, page_cursor), None)
+        if entry is not None and entry[1] > time.monotonic():
+            page = await entry[0]
+            if page is not None:
+                self.hits += 1
+                return page
+        elif entry is not None:
+            entry[0].cancel()
+
+        self.misses += 1
+        page = await self.load_page(externalNetwork, page_cursor)
+        return page if page is not None else ([], '', '')
+
+    async def load_page(self, externalNetwork, page_cursor, after=None):
+        # Returns (userList, next_cursor, prev_cursor), None when the page could not be loaded
+        try:
+            status, result, next_cursor, prev_cursor = await self.connect_client.list_entitlements(externalNetwork, page_cursor)
+            if status != 'OK':
+                return None
+
+            userList = result.get('entitlements', [])
+            if self.entitlement_index is not None:
+                self.entitlement_index.merge_page(externalNetwork, userList)
+            profiles = await self.user_resolver.get_user_profiles([u.symphonyId for u in userList])
+            if after is not None:
+                await after(userList, profiles)
+            return userList, next_cursor, prev_cursor
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception(f'Failed to load entitlement page for {externalNetwork}')
+            return None
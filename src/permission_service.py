@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+from .client.connect_client import AsyncConnectApiClient
+from .client.models import permission_names
+from .client.single_flight import SingleFlight
+
+
+class PermissionService():
+    # Permission lookups shared by the permission activities, with the catalog cached per network
+
+    # Defaults for the optional permissionCatalogTtl and advisorPermissionTtl settings of each context entry
+    DEFAULT_CATALOG_TTL = 3600
+    DEFAULT_ADVISOR_PERMISSION_TTL = 300
+
+    def __init__(self, connect_client: AsyncConnectApiClient, config):
+        self.connect_client = connect_client
+        self.config = config
+        self.catalogs = dict()
+        self.advisor_permissions = dict()
+        self.advisor_versions = dict()
+        self.single_flight = SingleFlight()
+        self.hits = {'catalog': 0, 'advisor': 0}
+        self.misses = {'catalog': 0, 'advisor': 0}
+
+    async def get_permission_catalog(self, externalNetwork):
+        entry = self.catalogs.get(externalNetwork)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits['catalog'] += 1
+            return entry[0]
+        self.misses['catalog'] += 1
+
+        # Simultaneous renders wait on the same fetch
+        return await self.single_flight.do(('catalog', externalNetwork), lambda: self.load_permission_catalog(externalNetwork))
+
+    async def refresh_permission_catalog(self, externalNetwork):
+        self.catalogs.pop(externalNetwork, None)
+        # Advisor permissions may also have been changed outside the bot, re-read them on next view
+        for key in [key for key in self.advisor_permissions if key[0] == externalNetwork]:
+            self.invalidate_advisor_permissions(*key)
+        return await self.get_permission_catalog(externalNetwork)
+
+    async def load_permission_catalog(self, externalNetwork):
+        status, result = await self.connect_client.list_permission(externalNetwork)
+        if status != 'OK':
+            # Failures are not cached so the next render retries
+            return []
+
+        permissions = permission_names(result)
+        ttl = self.config.context.get(externalNetwork).get("permissionCatalogTtl", self.DEFAULT_CATALOG_TTL)
+        self.catalogs[externalNetwork] = (permissions, time.monotonic() + ttl)
+        return permissions
+
+    async def get_advisor_permissions(self, externalNetwork, advisorEmail):
+        # Returns None when the permissions could not be retrieved
+        if advisorEmail == '':
+            return None
+
+        key = (externalNetwork, advisorEmail.lower())
+        entry = self.advisor_permissions.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits['advisor'] += 1
+            return list(entry[0])
+        self.misses['advisor'] += 1
+
+        return await self.single_flight.do(('advisor',) + key, lambda: self.load_advisor_permissions(externalNetwork, advisorEmail))
+
+    async def get_many_advisor_permissions(self, externalNetwork, symphonyIds, user_profiles):
+        # Returns {symphonyId: permissions or None}, all advisors looked up at once. The client
+        # bounds in-flight calls per network
+        advisorEmails = [user_profiles[symphonyId].email_address if user_profiles.get(symphonyId) is not None else ''
+                         for symphonyId in symphonyIds]
+        results = await asyncio.gather(*[self.get_advisor_permissions(externalNetwork, advisorEmail) for advisorEmail in advisorEmails],
+                                       return_exceptions=True)
+        output = dict()
+        for symphonyId, permissions in zip(symphonyIds, results):
+            if isinstance(permissions, Exception):
+                logging.error('Failed to get permissions for %s: %s', symphonyId, permissions)
+                permissions = None
+            output[symphonyId] = permissions
+
+        return output
+
+    async def load_advisor_permissions(self, externalNetwork, advisorEmail):
+        key = (externalNetwork, advisorEmail.lower())
+        version = self.advisor_versions.get(key, 0)
+        status, result = await self.connect_client.get_advisor_permission(externalNetwork, advisorEmail)
+        if status != 'OK':
+            return None
+
+        permissions = permission_names(result)
+        # Do not let a read that raced with one of our own edits overwrite it
+        if self.advisor_versions.get(key, 0) == version:
+            # Bounds how long changes made outside the bot can go unnoticed
+            ttl = self.config.context.get(externalNetwork).get("advisorPermissionTtl", self.DEFAULT_ADVISOR_PERMISSION_TTL)
+            self.advisor_permissions[key] = (permissions, time.monotonic() + ttl)
+        return list(permissions)
+
+    async def add_permission(self, externalNetwork, advisorEmail, permissionName):
+        status, result = await self.connect_client.add_permission(externalNetwork, advisorEmail, permissionName)
+        self.update_advisor_permissions(externalNetwork, advisorEmail, status, added=permissionName)
+        return status, result
+
+    async def delete_permission(self, externalNetwork, advisorEmail, permissionName):
+        status, result = await self.connect_client.delete_permission(externalNetwork, advisorEmail, permissionName)
+        self.update_advisor_permissions(externalNetwork, advisorEmail, status, removed=permissionName)
+        return status, result
+
+    async def apply_permissions(self, externalNetwork, advisorEmails, add_permissions, delete_permissions):
+        # Applies the same changes to every advisor at once.
+        # Returns {advisorEmail: {'DELETE': {permissionName: output}, 'ADD': {permissionName: output}}}
+        outputs = await asyncio.gather(*[self.apply_advisor_permissions(externalNetwork, advisorEmail, add_permissions, delete_permissions)
+                                         for advisorEmail in advisorEmails], return_exceptions=True)
+        permission_results = dict()
+        for advisorEmail, output in zip(advisorEmails, outputs):
+            if isinstance(output, Exception):
+                logging.error(f'Failed to apply permissions for {advisorEmail}: {output}')
+                error = {"status": 'ERROR', "result": f'ERROR: {output}'}
+                output = {
+                    "DELETE": {p: error for p in delete_permissions},
+                    "ADD": {p: error for p in add_permissions}
+                }
+            permission_results[advisorEmail] = output
+
+        return permission_results
+
+    async def apply_advisor_permissions(self, externalNetwork, advisorEmail, add_permissions, delete_permissions):
+        # Deletes run before adds for each advisor, as in the single user edit form
+        output = {"DELETE": dict(), "ADD": dict()}
+        for p1 in delete_permissions:
+            status, result = await self.delete_permission(externalNetwork, advisorEmail, p1)
+            output["DELETE"][p1] = {"status": status, "result": result}
+        for p2 in add_permissions:
+            status, result = await self.add_permission(externalNetwork, advisorEmail, p2)
+            output["ADD"][p2] = {"status": status, "result": result}
+        return output
+
+    def update_advisor_permissions(self, externalNetwork, advisorEmail, status, added=None, removed=None):
+        key = (externalNetwork, advisorEmail.lower())
+        self.advisor_versions[key] = self.advisor_versions.get(key, 0) + 1
+        entry = self.advisor_permissions.get(key)
+        if entry is None:
+            return
+
+        if status != 'OK':
+            # The outcome of a failed edit is unknown, re-read on next view
+            del self.advisor_permissions[key]
+            return
+
+        permissions = [p for p in entry[0] if p != removed]
+        if added is not None and added not in permissions:
+            permissions.append(added)
+        self.advisor_permissions[key] = (permissions, entry[1])
+
+    def invalidate_advisor_permissions(self, externalNetwork, advisorEmail):
+        key = (externalNetwork, advisorEmail.lower())
+        self.advisor_versions[key] = self.advisor_versions.get(key, 0) + 1
+        self.advisor_permissions.pop(key, None)
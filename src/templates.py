@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+from .tracing import span
+
+RESOURCES_DIR = Path(__file__).parent.parent / 'resources'
+
+
+class TracedTemplate(Template):
+    # Records every render in the trace of the running activity
+
+    def render(self, *args, **kwargs):
+        with span('render', template=self.name):
+            return super().render(*args, **kwargs)
+
+
+class TemplateRegistry():
+    # Compiled messageML templates shared by all activities
+
+    def __init__(self, resources_dir=RESOURCES_DIR, auto_reload=False, bytecode_cache_dir=None):
+        # Templates are compiled once, auto_reload re-checks the files on every use (dev only)
+        self.environment = Environment(
+            loader=FileSystemLoader(str(resources_dir)),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+            auto_reload=auto_reload,
+            autoescape=True
+        )
+        self.environment.template_class = TracedTemplate
+
+    def preload(self):
+        names = self.environment.list_templates(extensions=['jinja2'])
+        for name in names:
+            self.environment.get_template(name)
+        return names
+
+    def get(self, name):
+        return self.environment.get_template(name)
+
+    def render(self, name, **kwargs):
+        return self.get(name).render(**kwargs)
@@ -0,0 +1,132 @@
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+# JSON-lines trace records go to this logger, see the traceFileHandler in logging.conf
+TRACE_LOGGER = 'connect_bot.traces'
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span():
+    # One timed step of an activity, e.g. a Connect call, a template render or a send_message
+
+    __slots__ = ('name', 'attributes', 'start', 'end', 'children')
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return round((end - self.start) * 1000, 1)
+
+    def to_dict(self):
+        output = {'name': self.name, 'ms': self.duration_ms}
+        if self.attributes:
+            output['attributes'] = self.attributes
+        if self.children:
+            output['children'] = [child.to_dict() for child in self.children]
+        return output
+
+    def format_tree(self, depth=0):
+        attributes = ' '.join(f'{k}={v}' for k, v in self.attributes.items())
+        lines = [f'{"  " * depth}{self.name} {self.duration_ms}ms {attributes}'.rstrip()]
+        for child in sorted(self.children, key=lambda c: c.start):
+            lines.extend(child.format_tree(depth + 1))
+        return lines
+
+
+@contextmanager
+def span(name, **attributes):
+    # Records a child of the current span, a no-op outside of a traced activity (e.g. background refreshes)
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, **attributes)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as err:
+        child.attributes['error'] = type(err).__name__
+        raise
+    finally:
+        child.end = time.perf_counter()
+        current_span.reset(token)
+
+
+async def detached(coroutine):
+    # Runs a background task (created from an activity) outside of that activity's trace
+    current_span.set(None)
+    return await coroutine
+
+
+def annotate(**attributes):
+    # Adds attributes such as row counts to the current span
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+class ActivityTracer():
+    # Emits one JSON-lines trace per activity execution and logs the span tree of slow ones
+
+    DEFAULT_SLOW_THRESHOLD = 5
+
+    def __init__(self, slow_threshold=DEFAULT_SLOW_THRESHOLD, enabled=True):
+        self.slow_threshold = slow_threshold
+        self.enabled = enabled
+        self.trace_logger = logging.getLogger(TRACE_LOGGER)
+
+    def instrument(self, activity):
+        if not self.enabled:
+            return activity
+
+        on_activity = activity.on_activity
+
+        async def traced_on_activity(context):
+            root = Span(type(activity).__name__, **self.context_attributes(context))
+            token = current_span.set(root)
+            try:
+                return await on_activity(context)
+            except Exception as err:
+                root.attributes['error'] = type(err).__name__
+                raise
+            finally:
+                root.end = time.perf_counter()
+                current_span.reset(token)
+                self.record(root)
+
+        activity.on_activity = traced_on_activity
+        return activity
+
+    @staticmethod
+    def context_attributes(context):
+        form_values = getattr(context, 'form_values', None)
+        if form_values is not None:
+            return {
+                'form_id': context.form_id,
+                'action': form_values.get('action'),
+                'network': form_values.get('externalNetwork')
+            }
+        # Commands follow the bot @mention, e.g. "@Bot Name /status ..."
+        tokens = (context.text_content or '').split()
+        return {'command': next((t for t in tokens if t.startswith('/')), tokens[0] if tokens else '')}
+
+    def record(self, root):
+        trace = root.to_dict()
+        trace['timestamp'] = time.time()
+        self.trace_logger.info(json.dumps(trace, default=str))
+
+        if root.end - root.start >= self.slow_threshold:
+            logging.warning('Slow activity %s took %.1fs:\n%s', root.name, root.end - root.start,
+                            '\n'.join(root.format_tree()))
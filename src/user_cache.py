@@ -0,0 +1,52 @@
+import time
+from collections import OrderedDict
+
+
+class UserProfileCache():
+    # In-process LRU cache of Symphony user profiles keyed by str(symphonyId)
+
+    DEFAULT_MAX_SIZE = 5000
+    DEFAULT_TTL = 600
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, symphonyId):
+        key = str(symphonyId)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, symphonyId, profile):
+        key = str(symphonyId)
+        self.entries[key] = (profile, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, symphonyId):
+        self.entries.pop(str(symphonyId), None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,75 @@
+import logging
+
+from symphony.bdk.core.service.user.user_service import UserService
+from .client.models import AdvisorProfile
+from .user_cache import UserProfileCache
+
+
+class UserResolver():
+    # Resolves Symphony user profiles with one batch call per chunk of ids
+
+    DEFAULT_CHUNK_SIZE = 100
+
+    def __init__(self, users: UserService, cache: UserProfileCache, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._users = users
+        self.cache = cache
+        self.chunk_size = chunk_size
+
+    async def get_user_profiles(self, symphonyIds):
+        # Returns profiles keyed by str(symphonyId), ids not found on the pod are left out
+        resultDict = dict()
+        userIds = []
+
+        # Only users not seen recently are fetched from the pod
+        for symphonyId in dict.fromkeys(symphonyIds):
+            profile = self.cache.get(symphonyId)
+            if profile is not None:
+                resultDict[str(symphonyId)] = profile
+            else:
+                userIds.append(symphonyId)
+
+        for i in range(0, len(userIds), self.chunk_size):
+            chunk = userIds[i:i + self.chunk_size]
+            try:
+                output = await self._users.list_users_by_ids(user_ids=chunk)
+            except Exception as err:
+                logging.error(f'Failed to get user details for {len(chunk)} users: {err}')
+                continue
+
+            if 'users' in output:
+                for u in output['users']:
+                    profile = AdvisorProfile.from_user(u)
+                    resultDict[str(profile.id)] = profile
+                    self.cache.put(profile.id, profile)
+
+        return resultDict
+
+    async def resolve_users(self, userList):
+        # Returns a profile per requested id, keyed as given, None when the user is invalid
+        profiles = await self.get_user_profiles(userList)
+        return {symphonyId: profiles.get(str(symphonyId)) for symphonyId in userList}
+
+    async def get_user_profiles_by_emails(self, emails):
+        # Returns profiles keyed by lower-cased email, emails not found on the pod are left out
+        resultDict = dict()
+        emails = list(dict.fromkeys(emails))
+
+        for i in range(0, len(emails), self.chunk_size):
+            chunk = emails[i:i + self.chunk_size]
+            try:
+                output = await self._users.list_users_by_emails(emails=chunk)
+            except Exception as err:
+                logging.error(f'Failed to get user details for {len(chunk)} emails: {err}')
+                continue
+
+            if 'users' in output:
+                for u in output['users']:
+                    profile = AdvisorProfile.from_user(u)
+                    resultDict[profile.email_address.lower()] = profile
+                    self.cache.put(profile.id, profile)
+
+        return resultDict
+
+    @staticmethod
+    def invalid_user_profile(symphonyId):
+        return AdvisorProfile.invalid(symphonyId)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+from .client.connect_client import AsyncConnectApiClient
+from .permission_service import PermissionService
+from .templates import TemplateRegistry
+
+
+class StartupWarmup():
+    # Pays the first-use costs (key loading, JWT signing, TLS handshakes, catalog fetch and
+    # template compilation) before the datafeed starts, so the first admin action runs at steady state.
+    # Every network is warmed concurrently, a failed step is logged and left to happen on demand.
+
+    # Default for the optional warmup timeout setting, the bot starts regardless once it expires
+    DEFAULT_TIMEOUT = 60
+
+    def __init__(self, config, connect_client: AsyncConnectApiClient, permission_service: PermissionService,
+                 templates: TemplateRegistry, sessions=None, timeout=DEFAULT_TIMEOUT):
+        self.config = config
+        self.connect_client = connect_client
+        self.permission_service = permission_service
+        self.templates = templates
+        self._sessions = sessions
+        self.timeout = timeout
+        # (step, network) -> seconds, or the exception of a failed step
+        self.timings = dict()
+
+    async def run(self):
+        start = time.perf_counter()
+        steps = [self.timed('templates', None, self.load_templates)]
+        if self._sessions is not None:
+            steps.append(self.timed('symphony_session', None, self._sessions.get_session))
+        steps += [self.warm_network(externalNetwork) for externalNetwork in self.config.context.keys()]
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*steps), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning('Warm-up did not finish within %ss, remaining steps will run on first use', self.timeout)
+
+        elapsed = time.perf_counter() - start
+        failed = [key for key, value in self.timings.items() if isinstance(value, Exception)]
+        logging.info('Warm-up finished in %.2fs: %s', elapsed, self.format_timings())
+        if failed:
+            logging.warning('Bot ready, %d warm-up steps failed', len(failed))
+        else:
+            logging.info('Bot ready')
+        return self.timings
+
+    async def warm_network(self, externalNetwork):
+        # Steps of one network run in order, each one needs the previous
+        await self.timed('token', externalNetwork, lambda: self.connect_client.token_manager.get_token(externalNetwork))
+        await self.timed('session', externalNetwork, lambda: self.open_session(externalNetwork))
+        await self.timed('catalog', externalNetwork, lambda: self.permission_service.get_permission_catalog(externalNetwork))
+
+    async def timed(self, step, externalNetwork, function):
+        start = time.perf_counter()
+        try:
+            await function()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logging.warning('Warm-up step %s failed for %s: %s', step, externalNetwork or 'bot', err)
+            self.timings[(step, externalNetwork)] = err
+            return
+        self.timings[(step, externalNetwork)] = time.perf_counter() - start
+
+    async def load_templates(self):
+        # Compilation is blocking, keep it off the event loop while the networks warm up
+        await asyncio.get_running_loop().run_in_executor(None, self.templates.preload)
+
+    async def open_session(self, externalNetwork):
+        # Reads the trust store and builds the pooled session, the first connection is
+        # opened by the catalog fetch that follows
+        await asyncio.get_running_loop().run_in_executor(None, self.connect_client.get_ssl_context)
+        self.connect_client.get_session(externalNetwork)
+
+    def format_timings(self):
+        parts = []
+        for (step, externalNetwork), value in self.timings.items():
+            name = f'{externalNetwork} {step}' if externalNetwork else step
+            parts.append(f'{name} FAILED' if isinstance(value, Exception) else f'{name} {value:.2f}s')
+        return ', '.join(parts)